@@ -1,41 +1,1670 @@
 from fpdf import FPDF
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import matplotlib.ticker as ticker
 import datetime
-from matplotlib import font_manager
+import hashlib
+import io
+import os
+import copy
+import time
+import json
+import platform
+import tempfile
+import argparse
+import subprocess
+import sys
+import stat
+import threading
+import inspect
+import logging
+import functools
+import contextlib
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import urllib.parse
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class ListingIndex:
+
+    # fingerprint identifies the listings for the metrics cache. A loader that knows where they came from can pass one
+    # (a hash of the source file, say); otherwise the frame is hashed once, the first time metrics are cached for it
+    def __init__(self, df, region_types=(), fingerprint=None):
+
+        self.df = df
+        self.codes = {}
+        self.labels = {}
+        self.positions = {}
+        self.fingerprint = fingerprint
+
+        for column in ['Ownership', *region_types]:
+            self.add(column)
 
-mpl.rcParams['figure.dpi'] = 100
+    @staticmethod
+    def region_labels(regions):
+
+        # {region_type: labels} across every region and nested subregion
+        labels = {}
+        stack = list(regions.values())
+        while stack:
+            region = stack.pop()
+            labels.setdefault(region['region_type'], set()).update(region['labels'])
+            if region.get('subregions'):
+                stack.extend(region['subregions'].values())
+
+        return labels
+
+    @classmethod
+    def from_regions(cls, df, regions, fingerprint=None):
+
+        return cls(df, list(cls.region_labels(regions)), fingerprint)
+
+    def __len__(self):
+
+        return len(self.df)
+
+    def add(self, column):
+
+        if column in self.positions:
+            return
+
+        codes, labels = pd.factorize(self.df[column], use_na_sentinel=True)
+        order = np.argsort(codes, kind='stable')
+        splits = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+
+        self.codes[column] = codes
+        self.labels[column] = labels
+        self.positions[column] = {label: order[splits[i]:splits[i + 1]] for i, label in enumerate(labels)}
+
+    def rows(self, column, labels):
+
+        self.add(column)
+
+        found = [self.positions[column][label] for label in labels if label in self.positions[column]]
+        if not found:
+            return np.array([], dtype=np.intp)
+
+        return np.sort(np.concatenate(found))
+
+    def select(self, ownership=None, region=None):
+
+        positions = None
+
+        if ownership:
+            positions = self.rows('Ownership', [ownership])
+
+        if region:
+            region_rows = self.rows(region['region_type'], region['labels'])
+            if positions is None:
+                positions = region_rows
+            else:
+                positions = np.intersect1d(positions, region_rows, assume_unique=True)
+
+        if positions is None:
+            return self.df
+
+        return self.df.iloc[positions]
+
+
+class ListingLoader:
+
+    date_columns = ['ListDate', 'OffMarketDate', 'SettledDate', 'Agreement of Sale/Signed Lease Date']
+    number_columns = ['List Price', 'SoldPrice', 'DOM']
+    category_columns = ['Ownership', 'Status']
+
+    def __init__(self, path, regions=None, region_types=(), ownership_types=None, chunksize=250000, cache_dir=None):
+
+        self.path = path
+        self.chunksize = chunksize
+        self.ownership_types = ownership_types
+        self.cache_dir = cache_dir
+
+        # With a regions dict, rows outside every region and subregion are dropped while streaming. Region columns are
+        # read as text, so labels are too: a zip code given as a number still matches
+        if regions:
+            self.region_filter = {region_type: {str(label) for label in labels}
+                                  for region_type, labels in ListingIndex.region_labels(regions).items()}
+            self.region_types = list(dict.fromkeys([*region_types, *self.region_filter]))
+        else:
+            self.region_filter = None
+            self.region_types = list(region_types)
+
+        self.columns = self.category_columns + self.region_types + self.date_columns + self.number_columns
+
+    def raw_chunks(self):
+
+        if str(self.path).lower().endswith('.parquet'):
+            import pyarrow.parquet as pq
+
+            parquet = pq.ParquetFile(self.path)
+            for batch in parquet.iter_batches(batch_size=self.chunksize, columns=self.columns):
+                yield batch.to_pandas()
+
+        else:
+            text_columns = self.category_columns + self.region_types
+            yield from pd.read_csv(self.path, usecols=self.columns, dtype={column: str for column in text_columns},
+                                   chunksize=self.chunksize)
+
+    def downcast(self, chunk):
+
+        for column in self.date_columns:
+            chunk[column] = pd.to_datetime(chunk[column], errors='coerce')
+
+        for column in self.number_columns:
+            chunk[column] = pd.to_numeric(chunk[column], errors='coerce').round().astype('Int32')
+
+        for column in self.category_columns + self.region_types:
+            chunk[column] = chunk[column].astype('category')
+
+        return chunk
+
+    def chunks(self):
+
+        for chunk in self.raw_chunks():
+
+            if self.ownership_types:
+                chunk = chunk[chunk.Ownership.isin(self.ownership_types).fillna(False).to_numpy(dtype=bool)]
+
+            if self.region_filter:
+                keep = np.zeros(len(chunk), dtype=bool)
+                for region_type, labels in self.region_filter.items():
+                    keep |= chunk[region_type].isin(labels).fillna(False).to_numpy(dtype=bool)
+                chunk = chunk[keep]
+
+            yield self.downcast(chunk.reset_index(drop=True))
+
+    @staticmethod
+    def file_digest(path):
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+
+        return digest
+
+    def cache_path(self):
+
+        # Keyed on the source bytes plus everything that shapes the cleaned frame
+        digest = self.file_digest(self.path)
+        digest.update(repr((self.columns, sorted(self.ownership_types or []),
+                            sorted((k, sorted(map(str, v))) for k, v in (self.region_filter or {}).items()))).encode())
+
+        return os.path.join(self.cache_dir, f'{digest.hexdigest()}.feather')
+
+    def load(self):
+
+        if self.cache_dir is None:
+            return self.parse()
+
+        import pyarrow.feather as feather
+
+        path = self.cache_path()
+        if os.path.exists(path):
+            return feather.read_table(path, memory_map=True).to_pandas()
+
+        df = self.parse()
+        # Uncompressed so warm starts can memory-map the Arrow buffers instead of decompressing them
+        os.makedirs(self.cache_dir, exist_ok=True)
+        feather.write_feather(df, f'{path}.tmp', compression='uncompressed')
+        os.replace(f'{path}.tmp', path)
+
+        return df
+
+    def parse(self):
+
+        chunks = list(self.chunks())
+        if not chunks:
+            return self.downcast(pd.DataFrame(columns=self.columns))
+
+        # Chunks carry their own categories, so merge them rather than letting concat fall back to object
+        categoricals = {column: pd.api.types.union_categoricals([chunk[column] for chunk in chunks])
+                        for column in self.category_columns + self.region_types}
+        df = pd.concat([chunk.drop(columns=list(categoricals)) for chunk in chunks], ignore_index=True)
+        for column, values in categoricals.items():
+            df[column] = values
+
+        return df[self.columns]
+
+    def index(self):
+
+        return ListingIndex(self.load(), self.region_types)
+
+
+class MetricRegistry:
+
+    # Base metrics: (name, population, statistic, value, unit), one statistic over one population of listings per
+    # window. 'active' listings are those on the market at the window's end, 'new' were listed and 'sold' settled
+    # during it. Counts are of listings with a value; 'bands' is a mean per list price band, one column per band
+    base = [('Active Listings', 'active', 'count', 'List Price', 'count'),
+            ('Active Average List Price', 'active', 'mean', 'List Price', 'price'),
+            ('Active Median List Price', 'active', 'median', 'List Price', 'price'),
+            ('Active Average Days on Market', 'active', 'mean', 'DOM', 'days'),
+            ('Active Median Days on Market', 'active', 'median', 'DOM', 'days'),
+            ('New Listings', 'new', 'count', 'List Price', 'count'),
+            ('New Average List Price', 'new', 'mean', 'List Price', 'price'),
+            ('New Median List Price', 'new', 'median', 'List Price', 'price'),
+            ('New Average Days on Market', 'new', 'mean', 'DOM', 'days'),
+            ('New Median Days on Market', 'new', 'median', 'DOM', 'days'),
+            ('Sold Listings', 'sold', 'count', 'List Price', 'count'),
+            ('Sold Average List Price', 'sold', 'mean', 'List Price', 'price'),
+            ('Sold Median List Price', 'sold', 'median', 'List Price', 'price'),
+            ('Sold Average Sale Price', 'sold', 'mean', 'SoldPrice', 'price'),
+            ('Sold Median Sale Price', 'sold', 'median', 'SoldPrice', 'price'),
+            ('Sold Average Days on Market', 'sold', 'mean', 'DOM', 'days'),
+            ('Sold Median Days on Market', 'sold', 'median', 'DOM', 'days'),
+            ('Average Days on Market by Price Range', 'active', 'bands', 'DOM', 'days'),
+            ('Sold/List Price Ratio', 'sold', 'ratio', ('SoldPrice', 'List Price'), 'percent')]
+
+    # Derived metrics: (name, numerator, denominator, options), evaluated over the monthly rows in this order as
+    # scale * numerator / (denominator summed over the last `window` months). Annual rows take the value of the
+    # annual window's last month
+    derived = [('Months of Supply', 'Active Listings', 'Sold Listings',
+                {'scale': 3, 'window': 3, 'digits': 1, 'unit': 'months'})]
+
+    # % change of every column against the row `lag` months earlier; a lag of 12 also compares the annual rows.
+    # Adding ('MoM % Change', 1) gives month-over-month changes
+    changes = [('YoY % Change', 12)]
+
+    @classmethod
+    def base_columns(cls, price_labels):
+
+        columns = []
+        for name, population, statistic, value, unit in cls.base:
+            columns += list(price_labels) if statistic == 'bands' else [name]
+
+        return columns
+
+    @classmethod
+    def unit(cls, column):
+
+        units = {name: unit for name, population, statistic, value, unit in cls.base}
+        units.update({name: options['unit'] for name, numerator, denominator, options in cls.derived})
+
+        # Price band columns are named after their band
+        return units.get(column, 'days')
+
+    @classmethod
+    def label(cls, column):
+
+        # Counts, ratios and supply read as they are; the rest drop the population ('Active', 'New', 'Sold')
+        if cls.unit(column) in ('count', 'percent', 'months'):
+            return column
+        return ' '.join(column.split()[1:])
+
+    @classmethod
+    def evaluate(cls, rows, windows, current_year):
+
+        # rows holds one engine row per window: the monthly windows, then the current and prior year
+        months = pd.DatetimeIndex([end for start, end in windows[:-2]])
+        monthly = rows.iloc[:-2].set_axis(months)
+        annual = rows.iloc[-2:].reset_index(drop=True)
+        ends = [end for start, end in windows[-2:]]
+
+        for name, numerator, denominator, options in cls.derived:
+            denominators = monthly[denominator]
+            if options['window'] > 1:
+                denominators = denominators.rolling(window=options['window']).sum()
+            monthly[name] = (options['scale'] * monthly[numerator] / denominators).round(options['digits'])
+            annual[name] = monthly.loc[ends, name].to_numpy()
+
+        values = np.vstack([annual.to_numpy(dtype=float), monthly.to_numpy(dtype=float)])
+        columns = list(monthly.columns)
+
+        # All changes in one pass: each row is divided by the row lag months before it (NaN where there is none)
+        parts = [values]
+        positions = pd.Series(np.arange(len(months)) + 2, index=months)
+        for suffix, lag in cls.changes:
+            earlier = positions.reindex(months - pd.DateOffset(months=lag)).to_numpy()
+            earlier = np.concatenate([[1 if lag == 12 else np.nan, np.nan], earlier])
+            previous = np.full_like(values, np.nan)
+            found = ~np.isnan(earlier)
+            previous[found] = values[earlier[found].astype(int)]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                parts.append(np.round((values / previous - 1) * 100, 1))
+            columns += [f'{column} {suffix}' for column in monthly.columns]
+
+        values = np.hstack(parts)
+        values[np.isinf(values)] = np.nan
+
+        index = pd.Index([f'{current_year}', f'{current_year - 1}'] + list(months), dtype=object)
+        return pd.DataFrame(values, index=index, columns=columns)
+
+
+class MetricsEngine:
+
+    price_thresholds = [0, 500000, 750000, 1000000, 1500000, 2000000, 10000000]
+    price_labels = ['< $500k', r'\$500k - \$750k', r'\$750k - \$1M', r'\$1M - \$1.5M', r'\$1.5M - \$2M', r'> \$2M']
+
+    columns = MetricRegistry.base_columns(price_labels)
+
+    def __init__(self, windows, price_thresholds=None, price_labels=None):
+
+        self.price_thresholds, self.price_labels = self.price_bands(price_thresholds, price_labels)
+        self.columns = MetricRegistry.base_columns(self.price_labels)
+
+        self.windows = [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in windows]
+
+        # Every window edge becomes a bucket boundary, so each window is a contiguous run of buckets
+        self.bounds = np.unique(np.array([edge for window in self.windows for edge in window], dtype='datetime64[ns]'))
+        self.spans = np.searchsorted(self.bounds, np.array(self.windows, dtype='datetime64[ns]'))
+
+    @classmethod
+    def price_bands(cls, price_thresholds=None, price_labels=None):
+
+        if price_thresholds is None or list(price_thresholds) == cls.price_thresholds:
+            price_thresholds = cls.price_thresholds
+            if price_labels is None:
+                price_labels = cls.price_labels
+
+        price_thresholds = list(price_thresholds)
+        if price_labels is None:
+
+            def dollars(value):
+
+                return f'\\${value / 1e6:g}M' if value >= 1e6 else f'\\${value / 1e3:g}k'
+
+            price_labels = [f'{dollars(low)} - {dollars(high)}' for low, high in
+                            zip(price_thresholds[:-1], price_thresholds[1:])]
+            if price_thresholds[0] == 0:
+                price_labels[0] = f'< {dollars(price_thresholds[1])}'
+            price_labels[-1] = f'> {dollars(price_thresholds[-2])}'
+
+        if len(price_labels) != len(price_thresholds) - 1:
+            raise ValueError('price_labels needs one label per band between price_thresholds')
+
+        return price_thresholds, list(price_labels)
+
+    @staticmethod
+    def select(df, ownership=None, region=None):
+
+        if isinstance(df, ListingIndex):
+            return df.select(ownership, region)
+
+        mask = np.ones(len(df), dtype=bool)
+
+        if ownership:
+            mask &= df.Ownership.isin([ownership]).fillna(False).to_numpy(dtype=bool)
+
+        if region:
+            mask &= df[region['region_type']].isin(region['labels']).fillna(False).to_numpy(dtype=bool)
+
+        return df[mask]
+
+    @staticmethod
+    def dates(series):
+
+        return series.to_numpy(dtype='datetime64[ns]')
+
+    def buckets(self, dates):
+
+        bucket = np.searchsorted(self.bounds, dates, side='right') - 1
+        bucket[np.isnat(dates) | (bucket >= len(self.bounds) - 1)] = -1
+
+        return bucket
+
+    def members(self, bucket):
+
+        # (row, window) pairs for every window whose span covers the row's bucket, via a bucket -> windows table
+        buckets = np.arange(len(self.bounds))[:, None]
+        cover = (self.spans[:, 0] <= buckets) & (buckets < self.spans[:, 1])
+        covering = np.nonzero(cover)[1]
+        per_bucket = cover.sum(axis=1)
+        offsets = np.cumsum(per_bucket) - per_bucket
+
+        rows = np.flatnonzero(bucket >= 0)
+        count = per_bucket[bucket[rows]]
+        position = (np.repeat(offsets[bucket[rows]], count) + np.arange(count.sum())
+                    - np.repeat(np.cumsum(count) - count, count))
+
+        return np.repeat(rows, count), covering[position]
+
+    def active_intervals(self, df):
+
+        never = np.iinfo(np.int64).max
+        listed = self.dates(df.ListDate)
+        exits = np.stack([self.dates(df.OffMarketDate), self.dates(df.SettledDate),
+                          self.dates(df['Agreement of Sale/Signed Lease Date'])])
+        exited = np.where(np.isnat(exits), never, exits.view(np.int64)).min(axis=0)
+
+        # A listing is active at boundary k for first <= k < last, i.e. ListDate < bounds[k] <= its first exit date
+        bounds = self.bounds.view(np.int64)
+        first = np.searchsorted(bounds, listed.view(np.int64), side='right')
+        last = np.searchsorted(bounds, exited, side='right')
+        last = np.where(np.isnat(listed), first, np.maximum(last, first))
+
+        return first, last
+
+    def sweep(self, first, last, weights=None, groups=None, ngroups=1):
+
+        # Open/close events per boundary; the running total is what every interval covering that boundary adds up to.
+        # With groups, events are binned per (boundary, group) and the totals come back as a windows x groups array
+        size = (len(self.bounds) + 1) * ngroups
+        if groups is not None:
+            first = first * ngroups + groups
+            last = last * ngroups + groups
+        events = np.bincount(first, weights, minlength=size) - np.bincount(last, weights, minlength=size)
+        totals = np.cumsum(events.reshape(-1, ngroups), axis=0)[self.spans[:, 1]]
+
+        return totals if groups is not None else totals[:, 0]
+
+    def active_members(self, df, intervals=None):
+
+        first, last = intervals if intervals is not None else self.active_intervals(df)
+        length = last - first
+
+        rows = np.repeat(np.arange(len(df)), length)
+        boundary = np.repeat(first, length) + np.arange(len(rows)) - np.repeat(np.cumsum(length) - length, length)
+
+        # Map boundaries back to the windows ending there, via a per-boundary lookup table
+        ends = self.spans[:, 1]
+        order = np.argsort(ends, kind='stable')
+        per_boundary = np.bincount(ends, minlength=len(self.bounds))
+        lo = (np.cumsum(per_boundary) - per_boundary)[boundary]
+        count = per_boundary[boundary]
+        rows = np.repeat(rows, count)
+        position = np.repeat(lo, count) + np.arange(len(rows)) - np.repeat(np.cumsum(count) - count, count)
+
+        return rows, order[position]
+
+    def memberships(self, df, intervals=None):
+
+        sold_bucket = self.buckets(self.dates(df.SettledDate))
+        sold_bucket[~df.Status.isin(['Closed']).to_numpy(dtype=bool)] = -1
+
+        return [self.active_members(df, intervals), self.members(self.buckets(self.dates(df.ListDate))),
+                self.members(sold_bucket)]
+
+    def fingerprints(self, df):
+
+        # Order-independent hash of every listing feeding each window, so a window only changes when its listings do.
+        # Values are normalized first so a different date unit or price dtype does not look like changed data.
+        values = {column: self.dates(df[column]).view(np.int64) for column in
+                  ['ListDate', 'OffMarketDate', 'SettledDate', 'Agreement of Sale/Signed Lease Date']}
+        values['Closed'] = df.Status.isin(['Closed']).to_numpy(dtype=bool)
+        for column in ['List Price', 'SoldPrice', 'DOM']:
+            values[column] = df[column].to_numpy(dtype=float, na_value=np.nan)
+        row_hashes = pd.util.hash_pandas_object(pd.DataFrame(values), index=False).to_numpy()
+
+        # Summed per window off the same interval sweep and bucket ranges the engine uses, without expanding
+        # (row, window) pairs; uint64 sums wrap, which keeps them order-independent
+        size = len(self.bounds) + 1
+        first, last = self.active_intervals(df)
+        events = np.zeros(size, dtype=np.uint64)
+        np.add.at(events, first, row_hashes)
+        np.subtract.at(events, last, row_hashes)
+        fingerprints = np.cumsum(events)[self.spans[:, 1]]
+
+        sold_bucket = self.buckets(self.dates(df.SettledDate))
+        sold_bucket[~values['Closed']] = -1
+        for bucket in [self.buckets(self.dates(df.ListDate)), sold_bucket]:
+            rows = bucket >= 0
+            per_bucket = np.zeros(size, dtype=np.uint64)
+            np.add.at(per_bucket, bucket[rows] + 1, row_hashes[rows])
+            below = np.cumsum(per_bucket)
+            fingerprints += below[self.spans[:, 1]] - below[self.spans[:, 0]]
+
+        return fingerprints
+
+    @staticmethod
+    def mean(values, windows, n):
+
+        valid = ~np.isnan(values)
+        counts = np.bincount(windows[valid], minlength=n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.bincount(windows[valid], weights=values[valid], minlength=n) / counts
+
+    @staticmethod
+    def median(values, windows, n):
+
+        valid = ~np.isnan(values)
+        values = values[valid]
+        windows = windows[valid]
+        counts = np.bincount(windows, minlength=n)
+
+        # Lay each window's values out contiguously (a radix sort on small keys), then partition around the middle
+        keys = windows.astype(np.uint16) if n < 1 << 16 else windows
+        grouped = values[np.argsort(keys, kind='stable')]
+        ends = np.cumsum(counts)
+        medians = np.full(n, np.nan)
+        for w in np.flatnonzero(counts):
+            group = grouped[ends[w] - counts[w]:ends[w]]
+            half = counts[w] // 2
+            if counts[w] % 2:
+                medians[w] = np.partition(group, half)[half]
+            else:
+                group = np.partition(group, [half - 1, half])
+                medians[w] = (group[half - 1] + group[half]) / 2
+
+        return medians
+
+    def active_totals(self, values, intervals, groups=None, ngroups=1, sums=True):
+
+        # Counts (and sums) of the listings active at each window's end come straight off the interval sweep
+        first, last = intervals
+        valid = ~np.isnan(values)
+        totals = []
+        for weights in ([None, values[valid]] if sums else [None]):
+            if groups is None:
+                totals.append(self.sweep(first[valid], last[valid], weights))
+            else:
+                totals.append(self.sweep(first[valid], last[valid], weights, groups[valid], ngroups).T.reshape(-1))
+
+        return totals
+
+    def active_statistic(self, statistic, values, intervals, rows, windows, n, groups=None, ngroups=1):
+
+        # Only the medians need the expanded (row, window) pairs
+        if statistic == 'median':
+            return np.round(self.median(values[rows], windows, n))
+
+        if statistic == 'count':
+            return self.active_totals(values, intervals, groups, ngroups, sums=False)[0].astype(float)
+
+        counts, sums = self.active_totals(values, intervals, groups, ngroups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.round(sums / counts)
+
+    def statistic(self, statistic, values, windows, n):
+
+        # Rounded like Series.describe().round(0); empty windows give 0, NaN, NaN
+        if statistic == 'count':
+            return np.bincount(windows[~np.isnan(values)], minlength=n).astype(float)
+        if statistic == 'mean':
+            return np.round(self.mean(values, windows, n))
+        if statistic == 'median':
+            return np.round(self.median(values, windows, n))
+
+        # Mean of a per-listing ratio, as a percentage
+        return np.round(self.mean(values, windows, n) * 100, 2)
+
+    def band_totals(self, list_price, dom, intervals, n, groups=None, ngroups=1):
+
+        # Each listing falls in one right-closed band, as with pd.cut(..., price_thresholds), so every month x band
+        # DOM sum and count comes out of a single banded sweep
+        nbands = len(self.price_labels)
+        band = np.digitize(list_price, self.price_thresholds, right=True) - 1
+        valid = (band >= 0) & (band < nbands) & ~np.isnan(dom)
+        first, last = intervals[0][valid], intervals[1][valid]
+        band = band[valid] if groups is None else groups[valid] * nbands + band[valid]
+
+        def group_major(totals):
+
+            return totals.reshape(len(self.windows), ngroups, nbands).transpose(1, 0, 2).reshape(n, nbands)
+
+        return (group_major(self.sweep(first, last, dom[valid], band, nbands * ngroups)),
+                group_major(self.sweep(first, last, None, band, nbands * ngroups)))
+
+    def populations(self, df, groups=None):
+
+        values = {column: df[column].to_numpy(dtype=float, na_value=np.nan)
+                  for column in ['List Price', 'SoldPrice', 'DOM']}
+
+        # With groups (one id per row), every group gets its own run of windows: key g * len(windows) + w is window w
+        # of group g, computed exactly as if that group's rows had been aggregated on their own
+        intervals = self.active_intervals(df)
+        memberships = self.memberships(df, intervals)
+        if groups is not None:
+            memberships = [(rows, groups[rows] * len(self.windows) + windows) for rows, windows in memberships]
+
+        return values, intervals, dict(zip(['active', 'new', 'sold'], memberships))
+
+    def aggregate(self, df, groups=None, ngroups=1):
+
+        n = len(self.windows) * ngroups
+        values, intervals, memberships = self.populations(df, groups)
+
+        parts = []
+        for name, population, statistic, value, unit in MetricRegistry.base:
+            rows, windows = memberships[population]
+            if statistic == 'bands':
+                sums, counts = self.band_totals(values['List Price'], values[value], intervals, n, groups, ngroups)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    parts += list((sums / counts).T)
+            elif statistic == 'ratio':
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    ratio = values[value[0]][rows] / values[value[1]][rows]
+                parts.append(self.statistic(statistic, ratio, windows, n))
+            elif population == 'active':
+                parts.append(self.active_statistic(statistic, values[value], intervals, rows, windows, n, groups,
+                                                   ngroups))
+            else:
+                parts.append(self.statistic(statistic, values[value][rows], windows, n))
+
+        return pd.DataFrame(dict(zip(self.columns, parts)))
+
+    def partial(self, df, sketch, groups=None, ngroups=1):
+
+        # The same metrics as aggregate, kept as additive totals: counts and sums, and a quantile sketch per median
+        n = len(self.windows) * ngroups
+        values, intervals, memberships = self.populations(df, groups)
+
+        totals = {}
+        for name, population, statistic, value, unit in MetricRegistry.base:
+            rows, windows = memberships[population]
+            if statistic == 'bands':
+                sums, counts = self.band_totals(values['List Price'], values[value], intervals, n, groups, ngroups)
+                totals[name] = {'sum': sums, 'count': counts}
+            elif statistic == 'median':
+                totals[name] = {'sketch': sketch.add(values[value][rows], windows)}
+            elif population == 'active':
+                counts, sums = self.active_totals(values[value], intervals, groups, ngroups)
+                totals[name] = {'count': counts, 'sum': sums}
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    observed = (values[value[0]][rows] / values[value[1]][rows] if statistic == 'ratio'
+                                else values[value][rows])
+                valid = ~np.isnan(observed)
+                totals[name] = {'count': np.bincount(windows[valid], minlength=n),
+                                'sum': np.bincount(windows[valid], observed[valid], minlength=n)}
+
+        return MetricsPartial(self.columns, sketch, n, totals)
+
+
+class QuantileSketch:
+
+    # Mergeable quantile sketch with a relative error bound (the DDSketch layout): values fall in logarithmic buckets
+    # narrow enough that the bucket's representative value is within `error` of everything in it. A sketch is a sparse
+    # list of (key, count) with key = window * size + bucket, so sketches for many windows merge by adding counts.
+    # Zero and anything below `smallest`, negative values included, land in bucket 0 and read back as 0
+    def __init__(self, error=0.005, smallest=1e-3, largest=1e12):
+
+        self.error = error
+        self.smallest = smallest
+        self.gamma = (1 + error) / (1 - error)
+        self.log_gamma = np.log(self.gamma)
+        self.offset = int(np.ceil(np.log(smallest) / self.log_gamma)) - 1
+        self.size = int(np.ceil(np.log(largest) / self.log_gamma)) - self.offset + 1
+
+    def buckets(self, values):
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            buckets = np.ceil(np.log(values) / self.log_gamma) - self.offset
+        return np.where(values > self.smallest, np.clip(buckets, 1, self.size - 1), 0).astype(np.int64)
+
+    def values(self, buckets):
+
+        return np.where(buckets > 0, 2 * self.gamma ** (buckets + self.offset) / (self.gamma + 1), 0.0)
+
+    def add(self, values, windows):
+
+        valid = ~np.isnan(values)
+        keys = windows[valid].astype(np.int64) * self.size + self.buckets(values[valid])
+
+        return np.unique(keys, return_counts=True)
+
+    @staticmethod
+    def merge(sketches):
+
+        keys, inverse = np.unique(np.concatenate([keys for keys, counts in sketches]), return_inverse=True)
+        counts = np.bincount(inverse, np.concatenate([counts for keys, counts in sketches]))
+
+        return keys, counts.astype(np.int64)
+
+    def median(self, sketch, n):
+
+        keys, counts = sketch
+        totals = np.bincount(keys // self.size, counts, minlength=n).astype(np.int64)
+        cumulative = np.cumsum(counts)
+        starts = np.cumsum(totals) - totals
+
+        # Keys are sorted window by window, so a window's k-th value is at its start rank + k across all windows;
+        # even counts average the two middle values, like the exact median. Prices and days are whole numbers once
+        # loaded, so each value is read back as one; small ones (days) then come back exactly
+        def value_at(ranks):
+
+            return np.round(self.values(keys[np.searchsorted(cumulative, ranks, side='right')] % self.size))
+
+        medians = np.full(n, np.nan)
+        filled = np.flatnonzero(totals)
+        medians[filled] = (value_at(starts[filled] + (totals[filled] - 1) // 2)
+                           + value_at(starts[filled] + totals[filled] // 2)) / 2
+
+        return medians
+
+
+class MetricsPartial:
+
+    # Per-window totals for every base metric of some set of listings. Partials of disjoint sets (file chunks, shards)
+    # merge into the totals of their union: counts and means exactly (up to the order sums are added in), medians to
+    # within the sketch's error bound
+    def __init__(self, columns, sketch, n, totals):
+
+        self.columns = columns
+        self.sketch = sketch
+        self.n = n
+        self.totals = totals
+
+    @classmethod
+    def merge(cls, partials):
+
+        first = partials[0]
+        totals = {}
+        for name, parts in first.totals.items():
+            if 'sketch' in parts:
+                totals[name] = {'sketch': first.sketch.merge([partial.totals[name]['sketch'] for partial in partials])}
+            else:
+                totals[name] = {key: sum(partial.totals[name][key] for partial in partials) for key in parts}
+
+        return cls(first.columns, first.sketch, first.n, totals)
+
+    def rows(self):
+
+        parts = []
+        for name, population, statistic, value, unit in MetricRegistry.base:
+            totals = self.totals[name]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if statistic == 'count':
+                    parts.append(totals['count'].astype(float))
+                elif statistic == 'median':
+                    parts.append(np.round(self.sketch.median(totals['sketch'], self.n)))
+                elif statistic == 'bands':
+                    parts += list((totals['sum'] / totals['count']).T)
+                elif statistic == 'ratio':
+                    parts.append(np.round(totals['sum'] / totals['count'] * 100, 2))
+                else:
+                    parts.append(np.round(totals['sum'] / totals['count']))
+
+        return pd.DataFrame(dict(zip(self.columns, parts)))
+
+
+class MetricsCache:
+
+    def __init__(self, maxsize=256):
+
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+
+        return len(self.entries)
+
+    @staticmethod
+    def fingerprint(df):
+
+        # Only a ListingIndex is cached for: it carries its fingerprint, and its row positions already assume the frame
+        # isn't changed after indexing. A bare DataFrame can be edited in place, and hashing it on every call would
+        # cost about as much as a cache hit saves, so its metrics are simply computed
+        if not isinstance(df, ListingIndex):
+            return None
+
+        if df.fingerprint is None:
+            digest = hashlib.sha1(pd.util.hash_pandas_object(df.df, index=True).to_numpy().tobytes())
+            digest.update(repr((df.df.shape, list(df.df.columns))).encode())
+            df.fingerprint = digest.hexdigest()
+
+        return df.fingerprint
+
+    def key(self, df, ownership, region, windows, price_thresholds=None):
+
+        if region:
+            region_key = (region['region_type'], tuple(sorted(region['labels'])))
+        else:
+            region_key = None
+
+        if price_thresholds is None:
+            price_thresholds = MetricsEngine.price_thresholds
+
+        fingerprint = self.fingerprint(df)
+        if fingerprint is None:
+            return None
+
+        return ownership, region_key, tuple(windows), tuple(price_thresholds), fingerprint
+
+    def get(self, key):
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key].copy()
+
+        self.misses += 1
+        return None
+
+    def put(self, key, metrics):
+
+        self.entries[key] = metrics.copy()
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+
+class MetricsStore:
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.computed = 0
+        self.reused = 0
+        self.frames = {}
+
+    def path(self, ownership, region, price_thresholds=None):
+
+        if region:
+            key = (ownership, region['region_type'], sorted(map(str, region['labels'])))
+        else:
+            key = (ownership, None, None)
+
+        # Stores for the default price bands keep their original names
+        if price_thresholds is not None and list(price_thresholds) != MetricsEngine.price_thresholds:
+            key += (list(price_thresholds),)
+
+        return os.path.join(self.directory, f'{hashlib.sha1(repr(key).encode()).hexdigest()}.parquet')
+
+    def load(self, path, columns):
+
+        if not os.path.exists(path):
+            return pd.DataFrame(columns=['start', 'end', 'fingerprint', 'source'] + columns).set_index(['start', 'end'])
+
+        # Parsed stores stay in memory while their file is unchanged, so a warm lookup costs a stat, not a read
+        stamp = os.stat(path).st_mtime_ns
+        if path not in self.frames or self.frames[path][0] != stamp:
+            stored = pd.read_parquet(path).set_index(['start', 'end'])
+            if 'source' not in stored:
+                stored.insert(1, 'source', None)
+            self.frames[path] = (stamp, stored)
+
+        return self.frames[path][1]
+
+    def rows(self, engine, df, ownership=None, region=None, source=None):
+
+        path = self.path(ownership, region, engine.price_thresholds)
+        stored = self.load(path, engine.columns)
+        position = stored.index.get_indexer(pd.MultiIndex.from_tuples(engine.windows))
+
+        # Windows last stored or checked against the same listings (source is the ListingIndex fingerprint) are reused
+        # without hashing anything. The rest are fingerprinted, and only windows that are new, or whose listings
+        # changed since they were stored, go back through the engine
+        checked = np.zeros(len(position), dtype=bool)
+        if len(stored) and source is not None:
+            checked = (position >= 0) & (stored['source'].to_numpy(dtype=object)[np.maximum(position, 0)] == source)
+        stale = []
+        if not checked.all():
+            fingerprints = engine.fingerprints(df)
+            stored_fingerprints = stored['fingerprint'].to_numpy()[np.maximum(position, 0)] if len(stored) else 0
+            stale = np.flatnonzero((position < 0) | (stored_fingerprints != fingerprints)).tolist()
+        if stale:
+            fresh = MetricsEngine([engine.windows[i] for i in stale], engine.price_thresholds,
+                                  engine.price_labels).aggregate(df)
+            fresh.index = pd.MultiIndex.from_tuples([engine.windows[i] for i in stale], names=['start', 'end'])
+            fresh['fingerprint'] = fingerprints[stale]
+            fresh['source'] = None
+            stored = pd.concat([stored.drop(index=fresh.index, errors='ignore'), fresh[stored.columns]])
+            stored['fingerprint'] = stored['fingerprint'].astype(np.uint64)
+            position = stored.index.get_indexer(pd.MultiIndex.from_tuples(engine.windows))
+
+        self.computed += len(stale)
+        self.reused += len(engine.windows) - len(stale)
+
+        if stale or (source is not None and not checked.all()):
+            sources = stored['source'].to_numpy(dtype=object).copy()
+            sources[position] = source
+            stored['source'] = sources
+            os.makedirs(self.directory, exist_ok=True)
+            stored.reset_index().to_parquet(f'{path}.tmp', index=False)
+            os.replace(f'{path}.tmp', path)
+            self.frames[path] = (os.stat(path).st_mtime_ns, stored)
+
+        return pd.DataFrame(stored[engine.columns].to_numpy(dtype=float)[position], columns=engine.columns)
+
+class MetricsCube:
+
+    # Engine rows for every ownership type x region x window (monthly and annual), as one dense array. Regions are
+    # indexed by (region_type, labels), like the metrics cache, so any region with the same definition finds its slice.
+    # source records the listings the cube was built from ({'path': ..., 'fingerprint': ...}), so a saved cube is only
+    # reused for the same data
+    def __init__(self, values, ownership_types, regions, windows, columns, price_thresholds, source=None):
+
+        self.values = values
+        self.source = source
+        self.ownership_types = list(ownership_types)
+        self.regions = [(region_type, tuple(labels), name) for region_type, labels, name in regions]
+        self.windows = [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in windows]
+        self.columns = list(columns)
+        self.price_thresholds = list(price_thresholds)
+
+        self.ownership_index = {ownership: i for i, ownership in enumerate(self.ownership_types)}
+        self.region_index = {(region_type, labels): i for i, (region_type, labels, name) in enumerate(self.regions)}
+
+    @staticmethod
+    def region_key(region):
+
+        return region['region_type'], tuple(sorted(region['labels']))
+
+    @classmethod
+    def region_specs(cls, regions):
+
+        # Every region and subregion once, whether it is analyzed or only shown in an infographic
+        specs = {}
+        stack = list(regions.values())
+        while stack:
+            region = stack.pop(0)
+            specs.setdefault(cls.region_key(region), region['name'])
+            stack.extend((region.get('subregions') or {}).values())
+
+        return specs
+
+    @staticmethod
+    def groups(index, ownership_types, specs):
+
+        # Listings in more than one region (a subregion and its county) are repeated once per (ownership, region)
+        # group, so the engine sees every group in a single pass
+        positions = [np.intersect1d(index.rows('Ownership', [ownership]), index.rows(region_type, labels),
+                                    assume_unique=True)
+                     for ownership in ownership_types for region_type, labels in specs]
+        groups = np.repeat(np.arange(len(positions)), [len(rows) for rows in positions])
+
+        return np.concatenate(positions), groups, len(positions)
+
+    @classmethod
+    def build(cls, df, ownership_types, regions, windows, price_thresholds=None, price_labels=None):
+
+        if not isinstance(df, ListingIndex):
+            df = ListingIndex.from_regions(df, regions)
+
+        specs = cls.region_specs(regions)
+        rows, groups, ngroups = cls.groups(df, ownership_types, specs)
+
+        engine = MetricsEngine(windows, price_thresholds, price_labels)
+        return cls.from_rows(engine.aggregate(df.df.iloc[rows], groups, ngroups), engine, ownership_types, specs)
+
+    @classmethod
+    def build_sketched(cls, chunks, ownership_types, regions, windows, price_thresholds=None, price_labels=None,
+                       error=0.005, workers=None):
+
+        # Medians come from mergeable sketches, so listings can be streamed chunk by chunk, and the chunks spread over
+        # worker processes, instead of being held in memory at once; counts and means are still exact
+        specs = cls.region_specs(regions)
+        engine = MetricsEngine(windows, price_thresholds, price_labels)
+        task = (ownership_types, list(specs), engine.windows, engine.price_thresholds, engine.price_labels, error)
+
+        merged = None
+        if workers and workers > 1:
+            with process_pool(workers) as pool:
+                # A few chunks in flight per worker, so reading stays just ahead of the workers
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.submit(_chunk_partial, (chunk, *task)))
+                    while len(pending) > 2 * workers or (pending and pending[0].done()):
+                        partial = pending.popleft().result()
+                        merged = partial if merged is None else MetricsPartial.merge([merged, partial])
+                for future in pending:
+                    merged = future.result() if merged is None else MetricsPartial.merge([merged, future.result()])
+        else:
+            for chunk in chunks:
+                partial = _chunk_partial((chunk, *task))
+                merged = partial if merged is None else MetricsPartial.merge([merged, partial])
+
+        if merged is None:
+            raise ValueError('No listings to build a metrics cube from')
+
+        return cls.from_rows(merged.rows(), engine, ownership_types, specs)
+
+    @classmethod
+    def from_rows(cls, rows, engine, ownership_types, specs):
+
+        values = rows.to_numpy(dtype=float).reshape(len(ownership_types), len(specs), len(engine.windows), -1)
+
+        return cls(values, ownership_types, [(*key, name) for key, name in specs.items()], engine.windows,
+                   engine.columns, engine.price_thresholds)
+
+    def accuracy(self, exact):
+
+        # Every metric against a cube of the same sections built on the exact path. Relative errors are over the
+        # cells both have a value for; 'missing' counts cells only one of them has
+        report = {}
+        for i, column in enumerate(self.columns):
+            approximate = self.values[..., i].ravel()
+            truth = exact.values[..., exact.columns.index(column)].ravel()
+            both = ~np.isnan(approximate) & ~np.isnan(truth)
+            difference = np.abs(approximate[both] - truth[both])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                relative = np.where(truth[both] == 0, np.where(difference == 0, 0.0, np.inf),
+                                    difference / np.abs(truth[both]))
+            report[column] = {'cells': int(both.sum()), 'exact_cells': int((difference == 0).sum()),
+                              'max_absolute_error': difference.max() if len(difference) else 0.0,
+                              'max_relative_error': relative.max() if len(relative) else 0.0,
+                              'median_relative_error': np.median(relative) if len(relative) else 0.0,
+                              'missing': int((np.isnan(approximate) != np.isnan(truth)).sum())}
+
+        return pd.DataFrame(report).T
+
+    def covers(self, ownership, region, windows, price_thresholds):
+
+        return (ownership in self.ownership_index and region is not None
+                and self.region_key(region) in self.region_index
+                and [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in windows] == self.windows
+                and list(price_thresholds) == self.price_thresholds)
+
+    def rows(self, ownership, region):
+
+        values = self.values[self.ownership_index[ownership], self.region_index[self.region_key(region)]]
+        return pd.DataFrame(values, columns=self.columns)
+
+    def save(self, path):
+
+        labels = {'ownership_types': self.ownership_types, 'regions': [list(region) for region in self.regions],
+                  'columns': self.columns, 'price_thresholds': self.price_thresholds, 'source': self.source}
+        with open(path, 'wb') as cube_file:
+            np.savez(cube_file, values=self.values, windows=np.array(self.windows, dtype='datetime64[ns]'),
+                     labels=json.dumps(labels))
+
+    @classmethod
+    def load(cls, path, source=None):
+
+        with np.load(path) as cube_file:
+            labels = json.loads(str(cube_file['labels']))
+            cube = cls(cube_file['values'], labels['ownership_types'], labels['regions'], cube_file['windows'],
+                       labels['columns'], labels['price_thresholds'], labels.get('source'))
+
+        # Given the source it is meant for, a cube built from other data (or saved without a source) isn't returned
+        if source is not None and (cube.source or {}).get('fingerprint') != source['fingerprint']:
+            return None
+
+        return cube
+
+
+class MetricsExport:
+
+    extensions = {'arrow': 'arrow', 'parquet': 'parquet', 'csv': 'csv'}
+
+    # Without a directory, compose_report writes next to the report (or to the working directory); without formats,
+    # Arrow when pyarrow is installed and CSV otherwise
+    def __init__(self, directory=None, name='metrics', formats=None):
+
+        if formats is None:
+            import importlib.util
+            formats = ['arrow'] if importlib.util.find_spec('pyarrow') else ['csv']
+
+        self.directory = directory
+        self.name = name
+        self.formats = list(formats)
+        self.frames = {}
+        self.thread = None
+        self.error = None
+        self.paths = []
+
+    def __len__(self):
+
+        return len(self.frames)
+
+    def add(self, ownership, region, metrics):
+
+        if not self.formats:
+            return
+
+        # Keyed like the sections, so a region recomputed in the same run replaces its earlier frame
+        region_name = region['name'] if region else None
+        region_type = region['region_type'] if region else None
+        self.frames[(ownership, region_name)] = (region_type, metrics.copy())
+
+    def drain(self):
+
+        frames = self.frames
+        self.frames = {}
+        return frames
+
+    def extend(self, frames):
+
+        if self.formats:
+            self.frames.update(frames)
+
+    @staticmethod
+    def long_frame(frames):
+
+        # One row per (ownership, region, period, metric); annual rows are labelled by year, monthly rows by date
+        parts = []
+        for (ownership, region_name), (region_type, metrics) in frames.items():
+            periods = [period if isinstance(period, str) else period.strftime('%Y-%m-%d') for period in metrics.index]
+            values = metrics.set_axis(periods).rename_axis('period').rename_axis('metric', axis=1).stack(
+                future_stack=True).rename('value').reset_index()
+            values.insert(0, 'ownership', ownership)
+            values.insert(1, 'region', region_name)
+            values.insert(2, 'region_type', region_type)
+            values.insert(4, 'period_type', np.where(values['period'].str.len() == 4, 'year', 'month'))
+            parts.append(values)
+
+        long = pd.concat(parts, ignore_index=True)
+        for column in ['ownership', 'region', 'region_type', 'period', 'period_type', 'metric']:
+            long[column] = long[column].astype('category')
+        long['value'] = long['value'].astype(float)
+
+        return long
+
+    def write(self, frames):
+
+        try:
+            long = self.long_frame(frames)
+            directory = self.directory if self.directory is not None else os.getcwd()
+            os.makedirs(directory, exist_ok=True)
+
+            for output_format in self.formats:
+                path = os.path.join(directory, f'{self.name}.{self.extensions[output_format]}')
+                if output_format == 'arrow':
+                    import pyarrow.feather as feather
+                    # Arrow IPC without compression, so dashboards can memory-map it
+                    feather.write_feather(long, f'{path}.tmp', compression='uncompressed')
+                elif output_format == 'parquet':
+                    long.to_parquet(f'{path}.tmp', index=False)
+                else:
+                    long.to_csv(f'{path}.tmp', index=False)
+                os.replace(f'{path}.tmp', path)
+                self.paths.append(path)
+        except Exception as error:
+            self.error = error
+
+    def flush(self):
+
+        # Everything collected so far is written by one background thread; the report carries on meanwhile
+        self.wait()
+        if not self.frames:
+            return None
+
+        self.thread = threading.Thread(target=self.write, args=(dict(self.frames),), name='metrics-export')
+        self.thread.start()
+
+        return self.thread
+
+    def wait(self):
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+        return self.paths
+
+
+class ReportProfiler:
+
+    # The profiler whose stages are currently open, so static helpers like Report.parse_data can report to it;
+    # a disabled one (set below the class) when nothing is being profiled
+    active = None
+
+    def __init__(self, enabled=True, trace_memory=False):
+
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.records = []
+        self.stack = []
+        self.origin = time.perf_counter()
+        self.rss_reader = None
+        self.started_tracing = False
+        self.previous = None
+
+    def stage(self, name, ownership=None, region=None):
+
+        if not self.enabled:
+            return _null_stage
+
+        return self.timed(name, ownership, region)
+
+    @contextlib.contextmanager
+    def timed(self, name, ownership=None, region=None):
+
+        if isinstance(region, dict):
+            region = region['name']
+
+        # Stages without their own tags (charts, graphics) take them from the stage they run inside
+        if self.stack:
+            parent = self.stack[-1]
+            ownership = parent['ownership'] if ownership is None else ownership
+            region = parent['region'] if region is None else region
+        else:
+            self.previous, ReportProfiler.active = ReportProfiler.active, self
+            if self.trace_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+
+        frame = {'stage': name, 'ownership': ownership, 'region': region, 'children': 0.0, 'peak': 0}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['memory'] = current
+        self.stack.append(frame)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stack.pop()
+
+            record = {'stage': name, 'ownership': ownership, 'region': region,
+                      'start': round(start - self.origin, 6), 'seconds': seconds,
+                      'self_seconds': seconds - frame['children'], 'depth': len(self.stack),
+                      'rss': self.rss(), 'memory_delta': None, 'memory_peak': None, 'pid': os.getpid()}
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                frame['peak'] = max(frame['peak'], peak)
+                record['memory_delta'] = current - frame['memory']
+                record['memory_peak'] = frame['peak'] - frame['memory']
+            self.records.append(record)
+
+            if self.stack:
+                self.stack[-1]['children'] += seconds
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], frame['peak'])
+            else:
+                ReportProfiler.active = self.previous
+                if self.started_tracing:
+                    tracemalloc.stop()
+                    self.started_tracing = False
+
+    def rss(self):
+
+        if self.rss_reader is None:
+            try:
+                import psutil
+                process = psutil.Process()
+                self.rss_reader = lambda: process.memory_info().rss
+            except ImportError:
+                if os.path.exists('/proc/self/statm'):
+                    page_size = os.sysconf('SC_PAGE_SIZE')
+
+                    def statm():
+
+                        with open('/proc/self/statm') as statm_file:
+                            return int(statm_file.read().split()[1]) * page_size
+
+                    self.rss_reader = statm
+                else:
+                    self.rss_reader = lambda: None
+
+        return self.rss_reader()
+
+    def drain(self):
+
+        records = self.records
+        self.records = []
+
+        return records
+
+    def frame(self):
+
+        columns = ['stage', 'ownership', 'region', 'start', 'seconds', 'self_seconds', 'depth', 'rss', 'memory_delta',
+                   'memory_peak', 'pid']
+
+        return pd.DataFrame(self.records, columns=columns)
+
+    def summary(self, top=10):
+
+        # Hot sections ranked by time spent in the stage itself, not in the stages nested inside it
+        summary = self.frame().groupby(['stage', 'ownership', 'region'], dropna=False).agg(
+            calls=('seconds', 'size'), seconds=('seconds', 'sum'), self_seconds=('self_seconds', 'sum'),
+            max_seconds=('seconds', 'max'), memory_peak=('memory_peak', 'max'), rss=('rss', 'max'))
+        summary['share'] = (summary['self_seconds'] / summary['self_seconds'].sum()).round(4)
+
+        return summary.sort_values('self_seconds', ascending=False).head(top).reset_index()
+
+    def write(self, path, top=10):
+
+        summary = self.summary(top)
+        if path.endswith('.json'):
+            # Missing tags and memory figures go out as null rather than NaN
+            profile = {'stages': self.frame().astype(object).where(self.frame().notna(), None).to_dict('records'),
+                       'summary': summary.astype(object).where(summary.notna(), None).to_dict('records')}
+            with open(path, 'w') as profile_file:
+                json.dump(profile, profile_file, indent=1, default=str)
+        else:
+            root, extension = os.path.splitext(path)
+            self.frame().to_csv(path, index=False)
+            summary.to_csv(f'{root} summary{extension or ".csv"}', index=False)
+
+        return summary
+
+
+_null_stage = contextlib.nullcontext()
+ReportProfiler.active = ReportProfiler(enabled=False)
+
+
+def profiled(stage):
+
+    # Times a Report method as a profiler stage, tagged with its ownership type and region arguments when it has them
+    def decorate(method):
+
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+
+            if not self.profiler.enabled:
+                return method(self, *args, **kwargs)
+
+            arguments = signature.bind_partial(self, *args, **kwargs).arguments
+            ownership = arguments.get('ownership', arguments.get('ownership_type'))
+            with self.profiler.stage(stage, ownership, arguments.get('region')):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class FontRegistry:
+
+    # TTF files parsed once per process; each document gets a copy with its own glyph subset and font tables.
+    # The copy is built from fpdf's font attributes, so it is only used with the fpdf versions it was checked against;
+    # any other version parses the file for every document through pdf.add_font
+    fonts = {}
+    properties = {}
+    fpdf_versions = ('2.8.',)
+
+    @classmethod
+    def prototype(cls, family, style, path):
+
+        key = (os.path.abspath(path), style)
+        if key not in cls.fonts:
+            scratch = FPDF()
+            scratch.add_font(family, style, path)
+            font = next(iter(scratch.fonts.values()))
+            with open(path, 'rb') as font_file:
+                data = font_file.read()
+            # Fonts fpdf had to patch (e.g. a missing .notdef glyph) can't be rebuilt from the file, so they are
+            # simply parsed again for every document
+            patched = 'glyf' in font.ttfont and '.notdef' not in font.ttfont['glyf']
+            cls.fonts[key] = (font, data, patched)
+
+        return cls.fonts[key]
+
+    @classmethod
+    def add_font(cls, pdf, family, style, path):
+
+        import fpdf
+        from fontTools import ttLib
+
+        if not fpdf.FPDF_VERSION.startswith(cls.fpdf_versions):
+            return pdf.add_font(family, style, path)
+
+        prototype, data, patched = cls.prototype(family, style, path)
+        fontkey = f'{family.lower()}{"".join(sorted(style.upper()))}'
+        if patched or fontkey in pdf.fonts:
+            return pdf.add_font(family, style, path)
+
+        # Only the cmap is shared. Everything writing the PDF touches is the document's own: the fontTools tables are
+        # subset in place, the descriptor gets an object number (two families from one file must not share it), and
+        # the width table grows as text is drawn. Number, key and PDF version are what pdf.add_font would give it
+        try:
+            font = copy.copy(prototype)
+            font.i = len(pdf.fonts) + 1
+            font.fontkey = fontkey
+            font.ttfont = ttLib.TTFont(io.BytesIO(data), recalcTimestamp=False, lazy=True)
+            font.desc = copy.copy(prototype.desc)
+            font.cw = copy.copy(prototype.cw)
+            font.glyph_ids = dict(prototype.glyph_ids)
+            font.missing_glyphs = []
+            font.subset = type(prototype.subset)(font)
+        except (AttributeError, TypeError) as exception:
+            logger.warning('Parsing %s for this document, its parsed copy could not be reused: %s', path, exception)
+            return pdf.add_font(family, style, path)
+
+        pdf.fonts[fontkey] = font
+        if font.is_cff and font.is_cid_keyed:
+            pdf._set_min_pdf_version('1.6')
+
+    @classmethod
+    def font_properties(cls, path):
+
+        if path not in cls.properties:
+            from matplotlib import font_manager
+            cls.properties[path] = font_manager.FontProperties(fname=path)
+
+        return cls.properties[path]
+
+
+class ImageAssets:
+
+    # Part of every cache key, and bumped when resampling changes, so images cached by older code are prepared again
+    version = 2
+
+    # Images are resampled to the size they are placed at; 300 DPI keeps print quality with room to spare
+    def __init__(self, cache_dir=None, dpi=300, quality=85, workers=4):
+
+        self.cache_dir = cache_dir
+        self.dpi = dpi
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-assets')
+        self.prepared = {}
+        self.lock = threading.Lock()
+
+    def preload(self, placements):
+
+        # Decoding and resampling release the GIL, so every asset is prepared side by side while the report starts
+        for placement in placements:
+            self.future(*placement)
+
+    def future(self, path, width=None, height=None):
+
+        key = (path, width, height)
+        with self.lock:
+            if key not in self.prepared:
+                self.prepared[key] = self.executor.submit(self.prepare, path, width, height)
+
+            return self.prepared[key]
+
+    def get(self, path, width=None, height=None):
+
+        return io.BytesIO(self.future(path, width, height).result())
+
+    def prepare(self, path, width=None, height=None):
+
+        with open(path, 'rb') as image_file:
+            data = image_file.read()
+
+        digest = hashlib.sha1(data)
+        digest.update(repr((width, height, self.dpi, self.quality, self.version)).encode())
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir, f'{digest.hexdigest()}.img')
+            if os.path.exists(cache_path):
+                with open(cache_path, 'rb') as cached:
+                    return cached.read()
+
+        data = self.resample(data, width, height)
+
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(f'{cache_path}.tmp', 'wb') as cached:
+                cached.write(data)
+            os.replace(f'{cache_path}.tmp', cache_path)
+
+        return data
+
+    def resample(self, data, width=None, height=None):
+
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(data))
+        source_format = image.format
+
+        # Target pixels from the placed size in mm; the other side follows the aspect ratio, as it does in FPDF
+        if width is not None:
+            size = round(width / 25.4 * self.dpi), None
+            size = size[0], round(size[0] * image.height / image.width)
+        else:
+            size = round(height / 25.4 * self.dpi * image.width / image.height), round(height / 25.4 * self.dpi)
+
+        # Never upsample; an image already at or below its placed resolution is embedded as it is
+        if size[0] >= image.width:
+            return data
+
+        # JPEGs can decode straight at a reduced scale, which saves most of the work on large photos
+        if source_format == 'JPEG':
+            image.draft(image.mode, size)
+        icc_profile = image.info.get('icc_profile')
+
+        # Pillow resamples palette and 1-bit images with NEAREST whatever filter is asked for, so logos saved that
+        # way are expanded first
+        if image.mode in ('P', '1', 'LA'):
+            image = image.convert('RGBA' if image.mode == 'LA' or 'transparency' in image.info else 'RGB')
+
+        # JPEGs are written as RGB or greyscale; CMYK photos go through their own profile when they carry one
+        if source_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image, icc_profile = self.to_rgb(image, icc_profile), None
+
+        # A profile is only kept while it still describes the pixels (a CMYK or grey profile doesn't fit RGB output)
+        if icc_profile and icc_profile[16:20] != {'RGB': b'RGB ', 'RGBA': b'RGB ', 'L': b'GRAY'}.get(image.mode):
+            icc_profile = None
+
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        output = io.BytesIO()
+        if source_format == 'JPEG':
+            image.save(output, format='JPEG', quality=self.quality, optimize=True, icc_profile=icc_profile)
+        else:
+            image.save(output, format='PNG', optimize=True, icc_profile=icc_profile)
+
+        return output.getvalue()
+
+    @staticmethod
+    def to_rgb(image, icc_profile=None):
+
+        from PIL import ImageCms
+
+        if icc_profile:
+            try:
+                return ImageCms.profileToProfile(image, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                                                 ImageCms.createProfile('sRGB'), outputMode='RGB')
+            except ImageCms.PyCMSError:
+                pass
+
+        return image.convert('RGB')
+
+
+@functools.lru_cache(maxsize=None)
+def pyplot():
+
+    # The plotting stack is only imported (and configured) once a chart is actually drawn
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+
+    mpl.rcParams['figure.dpi'] = 100
+    mpl.rcParams['svg.hashsalt'] = 'coldwell-banker-market-report'
 
+    return plt
 
-class Report(FPDF):
 
-    def __init__(self, colors, fonts):
+class Report:
 
-        super().__init__()
+    # Images placed by compose_report; pass assets= to swap any of them out
+    assets = {'cover': r"C:\Users\Riley Chabot\Downloads\IMG_7111.jpg",
+              'cover_logos': [r"C:\Users\Riley Chabot\Downloads\HB-Logo-Horizontal_large.png"],
+              'copyright_logos': [r"C:\Users\Riley Chabot\Downloads\Best Logo.png",
+                                  r"C:\Users\Riley Chabot\Downloads\HB-Logo-Horizontal_large (1).png"],
+              'section_images': [r"C:\Users\Riley Chabot\Downloads\sfr.jpg", r"C:\Users\Riley Chabot\Downloads\condo.jpg",
+                                 r"C:\Users\Riley Chabot\Downloads\coop.jpg"],
+              'back_cover_logo': r"C:\Users\Riley Chabot\Downloads\HB-Logo-Horizontal_large.png"}
+
+    def __init__(self, colors, fonts, metrics_cache=None, chart_dir=None, chart_templates=True, chart_format='png',
+                 metrics_store=None, current_year=2022, history_start=None, price_thresholds=None, price_labels=None,
+                 profiler=None, metrics_export=None, site_name='HAGENBERGSTROM.COM', report_title=None,
+                 image_assets=None, metrics_cube=None):
 
         self.pdf = FPDF()
         self.pdf.set_auto_page_break(False)
 
         self.colors = colors
+        self.font_specs = fonts
 
+        # A font file that is missing or isn't a font is skipped, with a warning
+        from fontTools import ttLib
         self.font_families = []
-        #         self.mpl_font_paths = []
-        self.mpl_font_properties = []
+        self.mpl_font_paths = []
         for font in fonts:
             try:
-                self.pdf.add_font(*font)
+                FontRegistry.add_font(self.pdf, *font)
                 self.font_families.append(font[0])
 
-                #                 self.mpl_font_paths.append(Path(mpl.get_data_path(), font[2]))
-                self.mpl_font_properties.append(font_manager.FontProperties(fname=font[2]))
-            except:
-                pass
+                self.mpl_font_paths.append(font[2])
+            except (OSError, ttLib.TTLibError) as exception:
+                logger.warning('Skipping font %s (%s): %s', font[0], font[2], exception)
 
         self.page_no = 1
 
+        if metrics_cache is None:
+            metrics_cache = MetricsCache()
+        self.metrics_cache = metrics_cache
+        self.prerendered_charts = {}
+
+        # Charts stay in memory unless a directory is given to also export them as PNG files
+        self.chart_dir = chart_dir
+
+        # Styled figures kept per chart layout so later sections only swap in new data
+        self.chart_templates = {} if chart_templates else None
+
+        # 'svg' embeds charts as vector paths drawn by FPDF instead of PNG rasters
+        self.chart_format = chart_format
+
+        # Monthly history runs from history_start (default: January of the prior year) through current_year
+        self.current_year = current_year
+        self.metrics_windows(current_year, history_start)
+        self.history_start = history_start
+        self.metrics_store = metrics_store
+
+        # Precomputed engine rows for every section; with a cube covering the report, no listings are needed at all
+        self.metrics_cube = metrics_cube
+
+        # Running header text; the title also goes on the cover, one word per line
+        self.site_name = site_name
+        if report_title is None:
+            report_title = f'ANNUAL MARKET REPORT {current_year}'
+        self.report_title = report_title
+
+        # Cover, section and logo images, resampled to their placed size before they are embedded
+        if image_assets is None:
+            image_assets = ImageAssets()
+        self.image_assets = image_assets
+
+        # List price bands for the days on market breakdown; labels are derived from the thresholds if not given
+        self.price_thresholds, self.price_labels = MetricsEngine.price_bands(price_thresholds, price_labels)
+
+        # Stage timings (and memory, if the profiler traces it); a disabled profiler costs one attribute check per call
+        if profiler is None:
+            profiler = ReportProfiler(enabled=False)
+        self.profiler = profiler
+
+        # Every metrics frame computed during the run, written once as a single long-format file at the end
+        if metrics_export is None:
+            metrics_export = MetricsExport()
+        self.metrics_export = metrics_export
+
+    @contextlib.contextmanager
+    def fragment(self):
+
+        # Draws into a separate document with the same fonts, for pages that are merged into the report later
+        document, self.pdf = self.pdf, FPDF()
+        self.pdf.set_auto_page_break(False)
+        for font in self.font_specs:
+            if font[0] in self.font_families:
+                FontRegistry.add_font(self.pdf, *font)
+        try:
+            yield self.pdf
+        finally:
+            self.pdf = document
+
+    @property
+    def mpl_font_properties(self):
+
+        return [FontRegistry.font_properties(path) for path in self.mpl_font_paths]
+
     def text_accent(self, x, y, height):
 
         self.pdf.set_fill_color(*self.colors[0])
@@ -98,8 +1727,8 @@ class Report(FPDF):
         self.pdf.set_font(self.font_families[1], '', 8)
         self.pdf.set_text_color(100)
         self.pdf.set_xy(10, 0)
-        self.pdf.cell(40, 10, 'HAGENBERGSTROM.COM')
-        self.pdf.cell(0, 10, 'ANNUAL MARKET REPORT 2022', align='R')
+        self.pdf.cell(40, 10, self.site_name)
+        self.pdf.cell(0, 10, self.report_title, align='R')
         self.pdf.set_text_color(0)
 
     def footer(self):
@@ -118,7 +1747,7 @@ class Report(FPDF):
 
         self.pdf.add_page()
 
-        self.pdf.image(cover_image, x=0, y=0, w=210)
+        self.pdf.image(self.image_assets.get(cover_image, width=210), x=0, y=0, w=210)
 
         self.pdf.set_xy(10, 30)
         self.pdf.set_text_color(255)
@@ -133,7 +1762,7 @@ class Report(FPDF):
         #         self.pdf.set_fill_color(255)
         #         self.pdf.rect(x=150, y=225, w=50, h=62, style='F')
         #         self.pdf.image(logos[0], x=155, y=230, w=40)
-        self.pdf.image(logos[0], x=10, y=250, w=60)
+        self.pdf.image(self.image_assets.get(logos[0], width=60), x=10, y=250, w=60)
 
         self.pdf.set_text_color(0)
 
@@ -144,7 +1773,7 @@ class Report(FPDF):
         self.pdf.set_fill_color(*self.colors[0])
         self.pdf.rect(x=0, y=0, w=210, h=297, style='F')
 
-        self.pdf.image(logo, x=75, y=250, w=60)
+        self.pdf.image(self.image_assets.get(logo, width=60), x=75, y=250, w=60)
 
     def copyright_page(self, logos):
 
@@ -153,18 +1782,17 @@ class Report(FPDF):
         self.pdf.set_font(self.font_families[2], '', 12)
         self.pdf.set_xy(45, 150)
         self.pdf.multi_cell(120, 5,
-                            '©2023 Hagen Bergstrom Team, Coldwell Banker Realty. All rights reserved. All data sourced from Bright MLS. Data deemed reliable but not guaranteed.',
+                            f'©{self.current_year + 1} Hagen Bergstrom Team, Coldwell Banker Realty. All rights reserved. All data sourced from Bright MLS. Data deemed reliable but not guaranteed.',
                             align='C')
 
-        self.pdf.image(logos[0], x=160, y=230, w=40)
-        self.pdf.image(logos[1], x=10, y=250, w=60)
+        self.pdf.image(self.image_assets.get(logos[0], width=40), x=160, y=230, w=40)
+        self.pdf.image(self.image_assets.get(logos[1], width=60), x=10, y=250, w=60)
 
-    def add_table_of_contents(self, regions):
+    @profiled('add_table_of_contents')
+    def add_table_of_contents(self, plan):
 
         self.pdf.add_page()
 
-        ownership_types = ['Single Family Residences', 'Condominiums', 'Co-ops']
-
         self.accented_title(40, 65, 25, (self.font_families[0], '', 48), 'CONTENTS')
 
         margin = 50
@@ -172,73 +1800,39 @@ class Report(FPDF):
 
         y = 112.5
         self.pdf.set_xy(margin, 110)
-        page_no = 1
 
-        for ownership_type in ownership_types:
+        # Ownership types and the outlook sit at level 0, regions at level 1 and analyzed subregions at level 2; page
+        # numbers and link targets both come from the plan
+        entries = [unit for unit in plan if unit['level'] is not None]
+        for i, unit in enumerate(entries):
+
+            title, page_no = unit['title'], str(unit['number'])
+
+            if unit['level'] == 0:
+                if i:
+                    self.pdf.set_margins(left=margin, top=10, right=margin)
+                    self.pdf.ln(10)
+                    y += 10
+                self.pdf.set_font(self.font_families[1], '', 14)
+            elif unit['level'] == 1:
+                self.pdf.set_font(self.font_families[1], '', 10)
+                self.pdf.set_margins(left=margin + 5, top=10, right=margin)
+            else:
+                self.pdf.set_font(self.font_families[1], '', 8)
 
-            self.pdf.set_font(self.font_families[1], '', 14)
             link = self.pdf.add_link()
-            self.pdf.set_link(link, page=page_no + 3)
-            self.pdf.cell(50, 5, ownership_type, align='L', link=link)
-            self.pdf.cell(0, 5, str(page_no), align='R', new_x='LMARGIN', new_y='NEXT')
-            self.pdf.line(margin + 2 + self.pdf.get_string_width(ownership_type), y,
-                          210 - margin - (self.pdf.get_string_width(str(page_no)) + 2), y)
-
-            page_no += 1
-            y += 10
-            self.pdf.ln(5)
-
-            for region in regions:
-
-                if ownership_type in regions[region]['ownership_types']:
-
-                    self.pdf.set_font(self.font_families[1], '', 10)
-
-                    self.pdf.set_margins(left=margin + 5, top=10, right=margin)
-
-                    link = self.pdf.add_link()
-                    self.pdf.set_link(link, page=page_no + 3)
-                    self.pdf.cell(50, 5, region, align='L', link=link)
-                    self.pdf.cell(0, 5, str(page_no), align='R', new_x='LMARGIN', new_y='NEXT')
-                    self.pdf.line(7 + margin + self.pdf.get_string_width(region), y,
-                                  210 - margin - (self.pdf.get_string_width(str(page_no)) + 2), y)
-
-                    y += 5
-                    page_no += 4
-                    #                     page_no += 1
-                    self.pdf.set_margins(left=margin + 10, top=10, right=margin)
-
-                    if regions[region]['subregions']:
-                        all_subregions = regions[region]['subregions']
-                        subregions = [subregion for subregion in all_subregions if
-                                      (ownership_type in all_subregions[subregion]['ownership_types'])]
-                        if len(subregions) >= 3:
-                            page_no += ((len(subregions) - 1) // 7 + 1)
-                        self.pdf.set_font(self.font_families[1], '', 8)
-                        for subregion in subregions:
-
-                            if all_subregions[subregion]['analyze']:
-                                link = self.pdf.add_link()
-                                self.pdf.set_link(link, page=page_no + 3)
-                                self.pdf.cell(50, 5, subregion, align='L', link=link)
-                                self.pdf.cell(0, 5, str(page_no), align='R', new_x='LMARGIN', new_y='NEXT')
-                                self.pdf.line(12 + margin + self.pdf.get_string_width(subregion), y,
-                                              210 - margin - (self.pdf.get_string_width(str(page_no)) + 2), y)
-                                page_no += 4
-                                #                                 page_no += 1
-                                y += 5
-
-            self.pdf.set_margins(left=margin, top=10, right=margin)
-            self.pdf.ln(10)
-            y += 10
-
-        self.pdf.set_font(self.font_families[1], '', 14)
-        link = self.pdf.add_link()
-        self.pdf.set_link(link, page=page_no + 2)
-        self.pdf.cell(50, 5, '2023 Outlook', align='L', link=link)
-        self.pdf.cell(0, 5, str(page_no), align='R', new_x='LMARGIN', new_y='NEXT')
-        self.pdf.line(margin + 2 + self.pdf.get_string_width('2023 Outlook'), y,
-                      210 - margin - (self.pdf.get_string_width(str(page_no)) + 2), y)
+            self.pdf.set_link(link, page=unit['page'])
+            self.pdf.cell(50, 5, title, align='L', link=link)
+            self.pdf.cell(0, 5, page_no, align='R', new_x='LMARGIN', new_y='NEXT')
+            self.pdf.line(margin + 2 + 5 * unit['level'] + self.pdf.get_string_width(title), y,
+                          210 - margin - (self.pdf.get_string_width(page_no) + 2), y)
+
+            if unit['level'] == 0:
+                y += 10
+                self.pdf.ln(5)
+            else:
+                y += 5
+                self.pdf.set_margins(left=margin + 10, top=10, right=margin)
 
         self.pdf.set_margins(left=10, top=10, right=10)
 
@@ -277,7 +1871,7 @@ class Report(FPDF):
         self.pdf.add_page()
 
         with self.pdf.local_context(fill_opacity=1):
-            self.pdf.image(image_path, x=0, y=0, h=297)
+            self.pdf.image(self.image_assets.get(image_path, height=297), x=0, y=0, h=297)
 
         self.pdf.set_font(self.font_families[0], '', 48)
         self.pdf.set_text_color(255)
@@ -418,9 +2012,10 @@ class Report(FPDF):
         self.add_percentage(x - self.pdf.get_string_width(median_sale_price_yoy) / 2, y + 0.9 * radius,
                             self.pdf.get_string_width(median_sale_price_yoy), radius / 6, data[5], (0, 0, 0))
 
+    @profiled('infographic_page')
     def infographic_page(self, df, radius, ownership_type, region):
 
-        current_year = 2022
+        current_year = self.current_year
 
         per_page = 7
 
@@ -430,7 +2025,8 @@ class Report(FPDF):
                             subtitle='AREA SNAPSHOT', secondary_font=(self.font_families[1], '', 16))
         self.pdf.set_xy(10, 280)
         self.pdf.set_font(self.font_families[2], '', 10)
-        self.pdf.multi_cell(80, 4, '*Percentages are year-over-year changes \nfrom 2021 to 2022', align='L')
+        self.pdf.multi_cell(80, 4, '*Percentages are year-over-year changes \nfrom {} to {}'.format(
+            current_year - 1, current_year), align='L')
 
         all_subregions = region['subregions']
         subregions = [subregion for subregion in all_subregions if
@@ -477,7 +2073,7 @@ class Report(FPDF):
 
     def table(self, x, y, metrics, status, ownership, cols):
 
-        current_year = 2022
+        current_year = self.current_year
         date = datetime.datetime.strptime(f'{current_year + 1}-01-01', '%Y-%m-%d')
 
         df = metrics.fillna('N/A')
@@ -514,16 +2110,14 @@ class Report(FPDF):
 
         for col in cols:
 
-            if 'Listings' in col or 'Ratio' in col or 'Supply' in col:
-
-                if status == 'Active':
-                    table_columns[0].append(f'{col}*')
-                else:
-                    table_columns[0].append(col)
+            # Labels and number formats follow the metric's unit in MetricRegistry
+            unit = MetricRegistry.unit(col)
+            if unit in ('count', 'percent', 'months') and status == 'Active':
+                table_columns[0].append(f'{MetricRegistry.label(col)}*')
             else:
-                table_columns[0].append(' '.join(col.split()[1:]))
+                table_columns[0].append(MetricRegistry.label(col))
 
-            if 'Price' in col and 'Ratio' not in col:
+            if unit == 'price':
 
                 try:
                     table_columns[1].append('${:,}'.format(int(df.loc[current_year_index, col])))
@@ -533,7 +2127,7 @@ class Report(FPDF):
                     table_columns[2].append('${:,}'.format(int(df.loc[past_year_index, col])))
                 except:
                     table_columns[2].append('N/A')
-            elif 'Ratio' in col:
+            elif unit == 'percent':
 
                 try:
                     table_columns[1].append('{}%'.format(int(df.loc[current_year_index, col])))
@@ -582,7 +2176,7 @@ class Report(FPDF):
                             'Active Median List Price', 'Active Median Days on Market', 'Months of Supply'])
         self.pdf.set_xy(10, new_y + 1)
         self.pdf.set_font(self.font_families[2], '', 10)
-        self.pdf.cell(100, 5, '*As of Dec 31, 2022.')
+        self.pdf.cell(100, 5, f'*As of Dec 31, {self.current_year}.')
         new_y = self.table(10, new_y + 15, df, 'New', ownership,
                            ['New Listings', 'New Average List Price', 'New Average Days on Market',
                             'New Median List Price', 'New Median Days on Market'])
@@ -591,27 +2185,35 @@ class Report(FPDF):
                             'Sold/List Price Ratio', 'Sold Average Days on Market', 'Sold Median List Price',
                             'Sold Median Sale Price', 'Sold Median Days on Market'])
 
-    def chart(self, df, bar_vars, line_vars, ylabels, filename):
+    def build_chart(self, df, bar_vars, line_vars, ylabels):
 
         colors = ['black', 'red', 'blue', 'green', 'orange', 'magenta']
 
+        plt = pyplot()
+        import matplotlib as mpl
+        import matplotlib.ticker as ticker
+
         fig, ax = plt.subplots(figsize=(12, 6))
+        axes = [ax]
+        bars = []
+        lines = []
 
         if len(ylabels) == 2:
             ax2 = ax.twinx()
+            axes.append(ax2)
 
         if len(bar_vars) == 1:
-            ax.bar(df.index, df[bar_vars[0][0]],
-                   color=(self.colors[0][0] / 255, self.colors[0][1] / 255, self.colors[0][2] / 255), alpha=0.4,
-                   width=20, label=bar_vars[0][1])
+            bars.append(ax.bar(df.index, df[bar_vars[0][0]],
+                               color=(self.colors[0][0] / 255, self.colors[0][1] / 255, self.colors[0][2] / 255),
+                               alpha=0.4, width=20, label=bar_vars[0][1]))
 
         elif len(bar_vars) == 2:
-            ax.bar(df.index, df[bar_vars[0][0]],
-                   color=(self.colors[0][0] / 255, self.colors[0][1] / 255, self.colors[0][2] / 255), alpha=0.4,
-                   width=-10, label=bar_vars[0][1], align='edge')
-            ax.bar(df.index, df[bar_vars[1][0]],
-                   color=(self.colors[2][0] / 255, self.colors[2][1] / 255, self.colors[2][2] / 255), alpha=0.4,
-                   width=10, label=bar_vars[1][1], align='edge')
+            bars.append(ax.bar(df.index, df[bar_vars[0][0]],
+                               color=(self.colors[0][0] / 255, self.colors[0][1] / 255, self.colors[0][2] / 255),
+                               alpha=0.4, width=-10, label=bar_vars[0][1], align='edge'))
+            bars.append(ax.bar(df.index, df[bar_vars[1][0]],
+                               color=(self.colors[2][0] / 255, self.colors[2][1] / 255, self.colors[2][2] / 255),
+                               alpha=0.4, width=10, label=bar_vars[1][1], align='edge'))
 
         ax.xaxis.set_major_formatter(mpl.dates.DateFormatter("%b-%y"))
         for label in ax.xaxis.get_ticklabels():
@@ -624,7 +2226,8 @@ class Report(FPDF):
             else:
                 line_axis = ax
 
-            line_axis.plot(df.index, df[line_vars[i][0]], color=colors[i], alpha=0.4, label=line_vars[i][1])
+            lines.extend(line_axis.plot(df.index, df[line_vars[i][0]], color=colors[i], alpha=0.4,
+                                        label=line_vars[i][1]))
 
         ax.set_ylabel(ylabels[0], fontproperties=self.mpl_font_properties[2])
         if ylabels[0] == 'Price':
@@ -650,40 +2253,100 @@ class Report(FPDF):
         fig.legend(ncol=len(bar_vars + line_vars), bbox_to_anchor=(0.5, 0), loc='lower center', frameon=False,
                    prop=self.mpl_font_properties[2])
 
-        fig.savefig(filename, bbox_inches='tight')
-        plt.close()
+        return fig, axes, bars, lines
+
+    @profiled('chart')
+    def chart(self, df, bar_vars, line_vars, ylabels, filename=None):
+
+        key = (tuple(df.index), tuple(bar_vars), tuple(line_vars), tuple(ylabels))
+
+        if self.chart_templates is not None and key in self.chart_templates:
+            fig, axes, bars, lines = self.chart_templates[key]
+
+            for container, var in zip(bars, bar_vars):
+                for rect, height in zip(container.patches, df[var[0]]):
+                    rect.set_height(height)
+
+            for line, var in zip(lines, line_vars):
+                line.set_ydata(df[var[0]].to_numpy())
+
+            for axis in axes:
+                axis.relim()
+                axis.autoscale_view()
+
+        else:
+            fig, axes, bars, lines = self.build_chart(df, bar_vars, line_vars, ylabels)
+
+            if self.chart_templates is not None:
+                self.chart_templates[key] = (fig, axes, bars, lines)
+
+        image = io.BytesIO()
+        if self.chart_format == 'svg':
+            fig.savefig(image, format='svg', bbox_inches='tight',
+                        metadata={'Creator': None, 'Date': None, 'Format': None, 'Type': None})
+        else:
+            fig.savefig(image, format='png', bbox_inches='tight')
+
+        if self.chart_templates is None:
+            pyplot().close(fig)
+
+        if self.chart_dir is not None and filename:
+            with open(os.path.join(self.chart_dir, filename), 'wb') as f:
+                f.write(image.getvalue())
+
+        image.seek(0)
+        return image
+
+    def close_charts(self):
 
+        # Template figures stay registered with pyplot until closed, so a finished report lets go of them here
+        for fig, axes, bars, lines in (self.chart_templates or {}).values():
+            pyplot().close(fig)
+        if self.chart_templates is not None:
+            self.chart_templates.clear()
+
+    @profiled('charts')
     def charts(self, df, base_filename):
 
         df = df[2:]
         df.set_index((pd.Series(df.index) - pd.DateOffset(months=1)).values, inplace=True)
 
-        self.chart(df, [('New Listings', 'New Listings'), ('Sold Listings', 'Sold Listings')],
-                   [('Active Listings', 'Active Listings')], ['Units'],
-                   f'{base_filename} {"Active Listings, New Listings, and Sales Per Month"}.png')
-        self.chart(df, [('Sold Listings', 'Number of Sales')], [('Sold Median Sale Price', 'Median Sale Price')],
-                   ['Units', 'Price'], f'{base_filename} {"Median Sale Price and Number of Sales"}.png')
-        self.chart(df, [('Active Median Days on Market', 'Median Days on Market')],
-                   [('Sold Median Sale Price', 'Median Sale Price')], ['Days', 'Price'],
-                   f'{base_filename} {"Median Sale Price and Median Days on Market"}.png')
-        self.chart(df, [],
-                   [('< $500k', '< $500k'), ('\$500k - \$750k', '\$500k - \$750k'), ('\$750k - \$1M', '\$750k - \$1M'),
-                    ('\$1M - \$1.5M', '\$1M - \$1.5M'), ('\$1.5M - \$2M', '\$1.5M - \$2M'), ('> \$2M', '> \$2M')],
-                   ['Days'], f'{base_filename} {"Average Days on Market by Price Range"}.png')
-        self.chart(df, [('Active Average List Price', 'Average List Price'),
-                        ('Sold Average Sale Price', 'Average Sale Price')],
-                   [('Sold/List Price Ratio', 'Sold/List Price Ratio')], ['Price', 'Ratio'],
-                   f'{base_filename} {"Average Listing Price and Average Sale Price"}.png')
-        self.chart(df, [], [('Months of Supply', 'Months of Supply')], ['Months'],
-                   f'{base_filename} {"Months of Supply"}.png')
-
-    def graphic(self, x, y, image_path, title, property_types, descriptions):
+        images = {}
+
+        title = 'Active Listings, New Listings, and Sales Per Month'
+        images[title] = self.chart(df, [('New Listings', 'New Listings'), ('Sold Listings', 'Sold Listings')],
+                                   [('Active Listings', 'Active Listings')], ['Units'],
+                                   f'{base_filename} {title}.{self.chart_format}')
+        title = 'Median Sale Price and Number of Sales'
+        images[title] = self.chart(df, [('Sold Listings', 'Number of Sales')],
+                                   [('Sold Median Sale Price', 'Median Sale Price')], ['Units', 'Price'],
+                                   f'{base_filename} {title}.{self.chart_format}')
+        title = 'Median Sale Price and Median Days on Market'
+        images[title] = self.chart(df, [('Active Median Days on Market', 'Median Days on Market')],
+                                   [('Sold Median Sale Price', 'Median Sale Price')], ['Days', 'Price'],
+                                   f'{base_filename} {title}.{self.chart_format}')
+        title = 'Average Days on Market by Price Range'
+        images[title] = self.chart(df, [], [(label, label) for label in self.price_labels], ['Days'],
+                                   f'{base_filename} {title}.{self.chart_format}')
+        title = 'Average Listing Price and Average Sale Price'
+        images[title] = self.chart(df, [('Active Average List Price', 'Average List Price'),
+                                        ('Sold Average Sale Price', 'Average Sale Price')],
+                                   [('Sold/List Price Ratio', 'Sold/List Price Ratio')], ['Price', 'Ratio'],
+                                   f'{base_filename} {title}.{self.chart_format}')
+        title = 'Months of Supply'
+        images[title] = self.chart(df, [], [('Months of Supply', 'Months of Supply')], ['Months'],
+                                   f'{base_filename} {title}.{self.chart_format}')
+
+        return images
+
+    @profiled('graphic')
+    def graphic(self, x, y, image, title, property_types, descriptions):
 
         self.pdf.set_xy(x, y)
         self.pdf.set_font(self.font_families[1], '', 16)
         self.pdf.cell(150, 5, title.upper(), new_x='LMARGIN', new_y='NEXT')
         self.pdf.set_font('', '', 14)
-        self.pdf.cell(150, 7, '2022 | {}'.format(property_types), new_x='LMARGIN', new_y='NEXT')
+        self.pdf.cell(150, 7, '{} | {}'.format(self.current_year, property_types), new_x='LMARGIN', new_y='NEXT')
         current_y = y + 12
         for variable in descriptions:
             self.pdf.set_font(self.font_families[1], '', 10)
@@ -693,10 +2356,16 @@ class Report(FPDF):
             self.pdf.cell(150, 4, '| {}'.format(descriptions[variable]), new_x='LMARGIN', new_y='NEXT')
             current_y += 4
 
-        self.pdf.image(image_path, x=x, y=current_y + 5, h=90)
+        if self.chart_format == 'svg':
+            # Glyph paths in matplotlib's SVG inherit the current fill color
+            with self.pdf.local_context(fill_color=(0, 0, 0)):
+                self.pdf.image(image, x=x, y=current_y + 5, h=90)
+        else:
+            self.pdf.image(image, x=x, y=current_y + 5, h=90)
 
         return current_y + 90
 
+    @profiled('section')
     def section(self, df, ownership=None, region=None, charts=True):
 
         metrics = self.generate_metrics(df, ownership=ownership, region=region)
@@ -712,149 +2381,110 @@ class Report(FPDF):
 
         if charts:
             base_filename = f'{region["name"]} {ownership}'
-            print(base_filename)
-            self.charts(metrics, base_filename)
+            logger.debug('Charting %s', base_filename)
+            if base_filename in self.prerendered_charts:
+                images = self.prerendered_charts[base_filename]
+            else:
+                images = self.charts(metrics, base_filename)
 
             self.new_page()
             self.accented_title(10, 10, 15, (self.font_families[0], '', 20), region['name'])
-            new_y = self.graphic(10, 35, f'{base_filename} {"Active Listings, New Listings, and Sales Per Month"}.png',
+            new_y = self.graphic(10, 35, images['Active Listings, New Listings, and Sales Per Month'],
                                  'Active Listings, New Listings, and Sales Per Month', ownership,
                                  {'Active Listings': 'Number of properties listed for sale at the end of month.',
                                   'New Listings': 'Number of properties newly listed during the month.',
                                   'Sold Properties': 'Number of properties sold during the month.'})
-            self.graphic(10, new_y + 10, f'{base_filename} {"Median Sale Price and Number of Sales"}.png',
+            self.graphic(10, new_y + 10, images['Median Sale Price and Number of Sales'],
                          'Median Sale Price and Number of Sales', ownership,
                          {'Median Sale Price': 'Median of sale prices for properties sold during the month.',
                           'Number of Sales': 'Number of properties sold during the month.'})
 
             self.new_page()
             self.accented_title(10, 10, 15, (self.font_families[0], '', 20), region['name'])
-            new_y = self.graphic(10, 35, f'{base_filename} {"Median Sale Price and Median Days on Market"}.png',
+            new_y = self.graphic(10, 35, images['Median Sale Price and Median Days on Market'],
                                  'Median Sale Price and Median Days on Market', ownership,
                                  {'Median Sale Price': 'Median of sale prices for properties sold during the month.',
                                   'Median Days on Market': 'Median of days spent on market for all active properties at the end of the month.'})
-            self.graphic(10, new_y + 10, f'{base_filename} {"Average Days on Market by Price Range"}.png',
+            self.graphic(10, new_y + 10, images['Average Days on Market by Price Range'],
                          'Average Days on Market by Price Range', ownership, {
                              'Average Days on Market': 'Average days spent on market for all active properties at the end of the month.',
                              'Price Range': 'Range of listed price.'})
 
             self.new_page()
             self.accented_title(10, 10, 15, (self.font_families[0], '', 20), region['name'])
-            new_y = self.graphic(10, 35, f'{base_filename} {"Average Listing Price and Average Sale Price"}.png',
+            new_y = self.graphic(10, 35, images['Average Listing Price and Average Sale Price'],
                                  'Average Listing Price and Average Sale Price', ownership, {
                                      'Average Listing Price': 'Average list price for all active properties at the end of the month',
                                      'Average Sale Price': 'Average sale price for properties during the month',
                                      'Sold/List Ratio': 'Ratio of sale price to list price for properties sold during the month.'})
-            self.graphic(10, new_y + 10, f'{base_filename} {"Months of Supply"}.png', 'Months of Supply', ownership, {
+            self.graphic(10, new_y + 10, images['Months of Supply'], 'Months of Supply', ownership, {
                 'Months of Supply': 'Number of months the current inventory will last, given current absorption rate'})
 
     @staticmethod
     def parse_data(df, start, end, ownership=None, region=None):
 
-        price_thresholds = [0, 500000, 750000, 1000000, 1500000, 2000000, 10000000]
-
-        if ownership:
-            df = df[df.Ownership.isin([ownership]).fillna(False)]
-
-        if region:
-            df = df[df[region['region_type']].isin(region['labels']).fillna(False)]
-
-        active_listings = df[(df.ListDate < end) & ~(df.OffMarketDate < end) & ~(df.SettledDate < end) & ~(
-                    df['Agreement of Sale/Signed Lease Date'] < end)]
-        new_listings = df[(df.ListDate >= start) & (df.ListDate < end)]
-        sold_listings = df[(df.SettledDate >= start) & (df.SettledDate < end) & (df.Status.isin(['Closed']))]
-
-        row = pd.concat([active_listings['List Price'].describe().round(0).iloc[[0, 1, 5]].set_axis(
-            ['Active Listings', 'Active Average List Price', 'Active Median List Price']),
-                         active_listings['DOM'].describe().round(0).iloc[[1, 5]].set_axis(
-                             ['Active Average Days on Market', 'Active Median Days on Market']),
-                         new_listings['List Price'].describe().round(0).iloc[[0, 1, 5]].set_axis(
-                             ['New Listings', 'New Average List Price', 'New Median List Price']),
-                         new_listings['DOM'].describe().round(0).iloc[[1, 5]].set_axis(
-                             ['New Average Days on Market', 'New Median Days on Market']),
-                         sold_listings['List Price'].describe().round(0).iloc[[0, 1, 5]].set_axis(
-                             ['Sold Listings', 'Sold Average List Price', 'Sold Median List Price']),
-                         sold_listings['SoldPrice'].describe().round(0).iloc[[1, 5]].set_axis(
-                             ['Sold Average Sale Price', 'Sold Median Sale Price']),
-                         sold_listings['DOM'].describe().round(0).iloc[[1, 5]].set_axis(
-                             ['Sold Average Days on Market', 'Sold Median Days on Market']),
-                         ])
-
-        price_ranges = pd.cut(active_listings['List Price'], price_thresholds, right='False')
-        dom_breakdown = active_listings.groupby(by=price_ranges)['DOM'].mean().set_axis(
-            ['< $500k', '\$500k - \$750k', '\$750k - \$1M', '\$1M - \$1.5M', '\$1.5M - \$2M', '> \$2M'])
-        dom_breakdown.index.names = [None]
-        row = pd.concat([row, dom_breakdown])
-
-        row.loc['Sold/List Price Ratio'] = round((sold_listings.SoldPrice / sold_listings['List Price']).mean() * 100,
-                                                 2)
-
-        return row
-
-    def generate_metrics(self, df, ownership=None, region=None):
-
-        current_year = 2022
+        with ReportProfiler.active.stage('parse_data', ownership, region):
+            engine = MetricsEngine([(start, end)])
 
-        metrics = pd.DataFrame()
+            return engine.aggregate(engine.select(df, ownership, region)).iloc[0].rename(None)
 
-        dates = ['2021-01-01', '2021-02-01', '2021-03-01', '2021-04-01', '2021-05-01', '2021-06-01', '2021-07-01',
-                 '2021-08-01', '2021-09-01', '2021-10-01', '2021-11-01', '2021-12-01', '2022-01-01', '2022-02-01',
-                 '2022-03-01', '2022-04-01', '2022-05-01', '2022-06-01', '2022-07-01', '2022-08-01', '2022-09-01',
-                 '2022-10-01', '2022-11-01', '2022-12-01', '2023-01-01']
-        for i in range(len(dates) - 1):
-            start = datetime.datetime.strptime(dates[i], '%Y-%m-%d')
-            end = datetime.datetime.strptime(dates[i + 1], '%Y-%m-%d')
-
-            metrics[end] = self.parse_data(df, start, end, ownership, region)
+    @staticmethod
+    def metrics_windows(current_year=2022, history_start=None):
 
-        metrics = metrics.T
+        if history_start is None:
+            history_start = datetime.datetime(current_year - 1, 1, 1)
+        # Annual Months of Supply and the year-over-year changes read the prior year's monthly rows
+        elif pd.Timestamp(history_start) > datetime.datetime(current_year - 1, 1, 1):
+            raise ValueError(f'history_start must be on or before January {current_year - 1}, got {history_start}')
 
-        metrics['Months of Supply'] = (
-                    3 * metrics['Active Listings'] / metrics['Sold Listings'].rolling(window=3).sum()).round(1)
+        dates = [date.to_pydatetime() for date in
+                 pd.date_range(history_start, datetime.datetime(current_year + 1, 1, 1), freq='MS')]
 
-        start = datetime.datetime.strptime('2022-01-01', '%Y-%m-%d')
-        end = datetime.datetime.strptime('2023-01-01', '%Y-%m-%d')
+        start = datetime.datetime(current_year, 1, 1)
+        end = datetime.datetime(current_year + 1, 1, 1)
         past_start = start.replace(year=current_year - 1)
         past_end = end.replace(year=current_year)
 
-        current_year_metrics = self.parse_data(df, start, end, ownership, region)
-        past_year_metrics = self.parse_data(df, past_start, past_end, ownership, region)
-        current_year_metrics.name = f'{current_year}'
-        past_year_metrics.name = f'{current_year - 1}'
-
-        metrics = pd.concat([past_year_metrics.to_frame().T, metrics], ignore_index=False)
-        metrics = pd.concat([current_year_metrics.to_frame().T, metrics], ignore_index=False)
-
-        metrics.loc[f'{current_year}', 'Months of Supply'] = metrics.loc[end, 'Months of Supply']
-        metrics.loc[f'{current_year - 1}', 'Months of Supply'] = metrics.loc[past_end, 'Months of Supply']
-
-        metrics_all = metrics.copy()
-
-        for date in metrics.index:
+        # Monthly windows plus both annual windows, all covered by a single MetricsEngine pass
+        return [(dates[i], dates[i + 1]) for i in range(len(dates) - 1)] + [(start, end), (past_start, past_end)]
 
-            try:
+    def metrics_key(self, df, ownership=None, region=None):
 
-                yoy = ((metrics.loc[date] / metrics.loc[date.replace(year=date.year - 1)] - 1) * 100).round(1).set_axis(
-                    [f'{item} YoY % Change' for item in metrics.columns])
+        windows = self.metrics_windows(self.current_year, self.history_start)
 
-                metrics_all.loc[date, yoy.index] = yoy
+        return self.metrics_cache.key(df, ownership, region, windows, self.price_thresholds)
 
-            except:
+    @profiled('generate_metrics')
+    def generate_metrics(self, df, ownership=None, region=None):
 
-                try:
-                    yoy = ((metrics.loc[f'{current_year}'] / metrics.loc[f'{current_year - 1}'] - 1) * 100).round(
-                        1).set_axis([f'{item} YoY % Change' for item in metrics.columns])
+        current_year = self.current_year
 
-                    metrics_all.loc[f'{current_year}', yoy.index] = yoy
+        windows = self.metrics_windows(current_year, self.history_start)
 
-                except:
-                    pass
+        if self.metrics_cube is not None and self.metrics_cube.covers(ownership, region, windows,
+                                                                      self.price_thresholds):
+            cache_key = None
+            rows = self.metrics_cube.rows(ownership, region)
+        else:
+            cache_key = self.metrics_cache.key(df, ownership, region, windows, self.price_thresholds)
+            metrics_all = self.metrics_cache.get(cache_key) if cache_key is not None else None
+            if metrics_all is not None:
+                self.metrics_export.add(ownership, region, metrics_all)
+                return metrics_all
+
+            engine = MetricsEngine(windows, self.price_thresholds, self.price_labels)
+            if self.metrics_store is not None:
+                rows = self.metrics_store.rows(engine, engine.select(df, ownership, region), ownership, region,
+                                               self.metrics_cache.fingerprint(df))
+            else:
+                rows = engine.aggregate(engine.select(df, ownership, region))
 
-        #         metrics_all.fillna(0, inplace=True)
+        # Months of Supply, YoY changes and the rest of MetricRegistry's derived columns, all column-wise
+        metrics_all = MetricRegistry.evaluate(rows, windows, current_year)
+        self.metrics_export.add(ownership, region, metrics_all)
 
-        metrics_all.replace(np.inf, np.nan, inplace=True)
-        metrics_all.replace(-np.inf, np.nan, inplace=True)
-        metrics_all.to_csv(r'C:\Users\Riley Chabot\Downloads\{} {} metrics.csv'.format(region['name'], ownership))
+        if cache_key is not None:
+            self.metrics_cache.put(cache_key, metrics_all)
         return metrics_all
 
     def text_box(self, x, y, text, align='J'):
@@ -866,7 +2496,7 @@ class Report(FPDF):
     def forecast(self, sections):
 
         self.new_page()
-        self.accented_title(10, 30, 20, (self.font_families[0], '', 48), '2023 OUTLOOK')
+        self.accented_title(10, 30, 20, (self.font_families[0], '', 48), f'{self.current_year + 1} OUTLOOK')
         self.pdf.set_xy(10, 120)
 
         for i in range(len(sections)):
@@ -881,39 +2511,1249 @@ class Report(FPDF):
                 self.new_page()
                 self.pdf.set_xy(10, 20)
 
-    def compose_report(self, df, ownership_types, regions, forecast_text=None, charts=True, output_filename=None):
+    @staticmethod
+    def infographic_pages(region, ownership, per_page=7):
+
+        subregions = region['subregions'] or {}
+        listed = [subregion for subregion in subregions if (ownership in subregions[subregion]['ownership_types'])]
 
-        self.add_cover('ANNUAL\nMARKET\nREPORT\n2022', r"C:\Users\Riley Chabot\Downloads\IMG_7111.jpg",
-                       [r"C:\Users\Riley Chabot\Downloads\HB-Logo-Horizontal_large.png"])
-        self.copyright_page([r"C:\Users\Riley Chabot\Downloads\Best Logo.png",
-                             r"C:\Users\Riley Chabot\Downloads\HB-Logo-Horizontal_large (1).png"])
+        return (len(listed) - 1) // per_page + 1 if len(listed) >= 3 else 0
 
-        self.add_table_of_contents(regions)
+    def page_plan(self, ownership_types, regions, charts=True, forecast=False):
 
-        section_page_params = [(r"C:\Users\Riley Chabot\Downloads\sfr.jpg", 185, 200, 'Single Family\nResidences'),
-                               (r"C:\Users\Riley Chabot\Downloads\condo.jpg", 200, 80, 'Condominiums'),
-                               (r"C:\Users\Riley Chabot\Downloads\coop.jpg", 190, 255, 'Co-ops')]
+        # Every unit compose_report draws, in order, with its first pdf page, its page count and the number printed in
+        # its footer. Nothing is drawn, so the contents page can be laid out before the sections exist
+        plan = []
 
-        for i in range(len(ownership_types)):
+        def add(kind, pages, title=None, level=None, **unit):
+            page = 1
+            if plan:
+                # Only the back cover follows a unit of unknown length, and it is never linked to
+                page = plan[-1]['page'] + plan[-1]['pages'] if plan[-1]['pages'] else None
+            plan.append({'kind': kind, 'page': page, 'pages': pages, 'number': page - 3 if page and page > 3 else None,
+                         'title': title, 'level': level, **unit})
 
-            self.section_page(*section_page_params[i])
+        add('cover', 1)
+        add('copyright', 1)
+        add('contents', 1)
+
+        for i, ownership in enumerate(ownership_types):
+
+            add('section_page', 1, ownership, 0, ownership=ownership, index=i)
 
             for region in regions:
 
-                if ownership_types[i] in regions[region]['ownership_types']:
+                if ownership in regions[region]['ownership_types']:
 
-                    self.section(df, ownership=ownership_types[i], region=regions[region], charts=charts)
+                    add('section', self.infographic_pages(regions[region], ownership) + 1 + 3 * charts, region, 1,
+                        ownership=ownership, region=regions[region], charts=charts)
 
-                    subregions = regions[region]['subregions']
+                    subregions = regions[region]['subregions'] or {}
                     for subregion in subregions:
                         if subregions[subregion]['analyze'] and (
-                                ownership_types[i] in subregions[subregion]['ownership_types']):
-                            self.section(df, ownership=ownership_types[i], region=subregions[subregion], charts=charts)
-
-        if forecast_text:
+                                ownership in subregions[subregion]['ownership_types']):
+                            add('section', self.infographic_pages(subregions[subregion], ownership) + 1 + 3 * charts,
+                                subregion, 2, ownership=ownership, region=subregions[subregion], charts=charts)
+
+        if forecast:
+            add('forecast', None, f'{self.current_year + 1} Outlook', 0)
+        add('back_cover', 1)
+
+        return plan
+
+    def render_unit(self, df, unit, plan=None, assets=None, forecast_text=None):
+
+        # Draws one unit of the plan on its own: the footer numbers come from the plan, not from the pages before it
+        assets = {**self.assets, **(assets or {})}
+        if unit['number']:
+            self.page_no = unit['number']
+        first_page = self.pdf.page
+
+        if unit['kind'] == 'cover':
+            self.add_cover('\n'.join(self.report_title.split()), assets['cover'], assets['cover_logos'])
+        elif unit['kind'] == 'copyright':
+            self.copyright_page(assets['copyright_logos'])
+        elif unit['kind'] == 'contents':
+            self.add_table_of_contents(plan)
+        elif unit['kind'] == 'section_page':
+            self.section_page(*self.section_page_params(assets, unit['ownership'], unit['index']))
+        elif unit['kind'] == 'section':
+            self.section(df, ownership=unit['ownership'], region=unit['region'], charts=unit['charts'])
+        elif unit['kind'] == 'forecast':
             self.forecast(forecast_text)
+        elif unit['kind'] == 'back_cover':
+            self.add_back_cover(assets['back_cover_logo'])
+
+        # A unit that drew a different number of pages than planned would leave every later link pointing elsewhere
+        if unit['pages'] and self.pdf.page - first_page != unit['pages']:
+            raise RuntimeError(f'{unit["kind"]} {unit["title"] or ""} drew {self.pdf.page - first_page} pages, '
+                               f'the page plan has {unit["pages"]}')
+
+    @staticmethod
+    def section_page_params(assets, ownership, index):
+
+        section_page_params = [(assets['section_images'][0], 185, 200, 'Single Family\nResidences'),
+                               (assets['section_images'][1], 200, 80, 'Condominiums'),
+                               (assets['section_images'][2], 190, 255, 'Co-ops')]
+        # Matched by title, so a report of just condos still opens its section with the condo page
+        titles = [params[3].replace('\n', ' ') for params in section_page_params]
+
+        return section_page_params[titles.index(ownership) if ownership in titles else index]
+
+    @staticmethod
+    def section_tasks(ownership_types, regions, charts=True):
+
+        # Every (ownership, region) pair compose_report will need metrics for, in page order
+        tasks = {}
+
+        def add(ownership, region, with_charts):
+            key = (ownership, region['name'])
+            if key in tasks:
+                tasks[key] = (ownership, region, tasks[key][2] or with_charts)
+            else:
+                tasks[key] = (ownership, region, with_charts)
+
+        for ownership in ownership_types:
+            for region in regions:
+
+                if ownership in regions[region]['ownership_types']:
 
-        self.add_back_cover(r"C:\Users\Riley Chabot\Downloads\HB-Logo-Horizontal_large.png")
+                    add(ownership, regions[region], charts)
+
+                    subregions = regions[region]['subregions'] or {}
+                    listed = [subregion for subregion in subregions if
+                              (ownership in subregions[subregion]['ownership_types'])]
+                    if len(listed) >= 3:
+                        for subregion in listed:
+                            add(ownership, subregions[subregion], False)
+
+                    for subregion in subregions:
+                        if subregions[subregion]['analyze'] and (
+                                ownership in subregions[subregion]['ownership_types']):
+                            add(ownership, subregions[subregion], charts)
+
+        return list(tasks.values())
+
+    def cube_covers(self, ownership_types, regions):
+
+        windows = self.metrics_windows(self.current_year, self.history_start)
+        return self.metrics_cube is not None and all(
+            self.metrics_cube.covers(ownership, region, windows, self.price_thresholds)
+            for ownership, region, with_charts in self.section_tasks(ownership_types, regions))
+
+    def worker_options(self, export_formats=()):
+
+        return {'chart_dir': self.chart_dir, 'chart_format': self.chart_format, 'metrics_store': self.metrics_store,
+                'current_year': self.current_year, 'history_start': self.history_start,
+                'price_thresholds': self.price_thresholds, 'price_labels': self.price_labels,
+                'profiler': ReportProfiler(self.profiler.enabled, self.profiler.trace_memory),
+                'metrics_export': MetricsExport(formats=export_formats), 'site_name': self.site_name,
+                'report_title': self.report_title, 'metrics_cube': self.metrics_cube}
+
+    def prerender_sections(self, df, ownership_types, regions, charts=True, workers=None):
+
+        tasks = self.section_tasks(ownership_types, regions, charts)
+
+        initargs = (self.colors, self.font_specs, self.worker_options(), df)
+        with process_pool(workers, initializer=_init_section_worker, initargs=initargs) as pool:
+
+            for (ownership, region, with_charts), (metrics, images, records) in zip(tasks,
+                                                                                   pool.map(_render_section, tasks)):
+
+                self.profiler.records.extend(records)
+                self.metrics_export.add(ownership, region, metrics)
+                # Rendered from a metrics cube there are no listings to key the cache on, and nothing to cache
+                key = self.metrics_key(df, ownership, region) if df is not None else None
+                if key is not None:
+                    self.metrics_cache.put(key, metrics)
+                if with_charts:
+                    self.prerendered_charts[f'{region["name"]} {ownership}'] = images
+
+    def render_shards(self, df, plan, assets=None, forecast_text=None, workers=None):
+
+        # Sections are drawn into their own documents in worker processes while this process draws everything else,
+        # with blank pages standing in for the sections so the contents page can still link to them
+        sections = [unit for unit in plan if unit['kind'] == 'section']
+
+        initargs = (self.colors, self.font_specs, self.worker_options(self.metrics_export.formats), df)
+        with process_pool(workers, initializer=_init_section_worker, initargs=initargs) as pool:
+
+            results = pool.map(_render_fragment, [(unit, assets) for unit in sections])
+
+            for unit in plan:
+                if unit['kind'] == 'section':
+                    for _ in range(unit['pages']):
+                        self.pdf.add_page()
+                else:
+                    self.render_unit(df, unit, plan, assets, forecast_text)
+
+            fragments = []
+            for fragment, frames, records in results:
+                fragments.append(fragment)
+                self.metrics_export.extend(frames)
+                self.profiler.records.extend(records)
+
+        with self.profiler.stage('merge_shards'):
+            return self.merge_shards(bytes(self.pdf.output()), sections, fragments)
+
+    @staticmethod
+    def merge_shards(document, sections, fragments):
+
+        from pypdf import PdfReader, PdfWriter
+
+        writer = PdfWriter(clone_from=io.BytesIO(document))
+
+        # Each placeholder page is swapped for its fragment page; links on the contents page point at page objects,
+        # so they are moved over to the replacements
+        replaced = {}
+        for unit, fragment in zip(sections, fragments):
+            for offset, page in enumerate(PdfReader(io.BytesIO(fragment)).pages):
+                index = unit['page'] - 1 + offset
+                placeholder = writer.pages[index].indirect_reference
+                writer.insert_page(page, index)
+                writer.remove_page(index + 1)
+                replaced[placeholder.idnum] = writer.pages[index].indirect_reference
+
+        for page in writer.pages:
+            for annotation in page.get('/Annots', []):
+                destination = annotation.get_object().get('/Dest')
+                if destination and destination[0].idnum in replaced:
+                    destination[0] = replaced[destination[0].idnum]
+
+        # Fragments each embed their own copy of shared resources (logos, identical font subsets); identical objects
+        # are written once, and the placeholder pages are dropped
+        writer.compress_identical_objects()
+
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
+
+    @profiled('compose_report')
+    def compose_report(self, df, ownership_types, regions, forecast_text=None, charts=True, output_filename=None,
+                       workers=None, assets=None, sharded=False, cube=False, wait_export=True):
+
+        assets = {**self.assets, **(assets or {})}
+        self.image_assets.preload([(assets['cover'], 210), (assets['cover_logos'][0], 60),
+                                   (assets['copyright_logos'][0], 40), (assets['copyright_logos'][1], 60),
+                                   (assets['back_cover_logo'], 60)]
+                                  + [(self.section_page_params(assets, ownership, i)[0], None, 297)
+                                     for i, ownership in enumerate(ownership_types)])
+
+        if df is not None and not isinstance(df, ListingIndex):
+            df = ListingIndex.from_regions(df, regions)
+
+        # One grouped pass over the listings for every section's metrics, after which each section is a slice
+        if cube and not self.cube_covers(ownership_types, regions):
+            with self.profiler.stage('metrics_cube'):
+                self.metrics_cube = MetricsCube.build(df, ownership_types, regions,
+                                                      self.metrics_windows(self.current_year, self.history_start),
+                                                      self.price_thresholds, self.price_labels)
+
+        # Page numbers, contents entries and link targets all come from the plan, which is built before any drawing
+        plan = self.page_plan(ownership_types, regions, charts, forecast=bool(forecast_text))
+
+        # Sharded, each section's pages are drawn in a worker and merged into the report at the end; otherwise
+        # metrics and charts can still be built up front in a process pool, and the pages are drawn here, in order
+        # The chart templates are closed even when drawing fails, so a long-running server doesn't collect figures
+        self.sharded_output = None
+        try:
+            if sharded and workers and workers > 1:
+                self.sharded_output = self.render_shards(df, plan, assets, forecast_text, workers)
+            else:
+                if workers and workers > 1:
+                    self.prerender_sections(df, ownership_types, regions, charts, workers)
+
+                for unit in plan:
+                    self.render_unit(df, unit, plan, assets, forecast_text)
+        finally:
+            self.close_charts()
+        if self.metrics_export.directory is None and output_filename:
+            self.metrics_export.directory = os.path.dirname(os.path.abspath(output_filename))
+        self.metrics_export.flush()
 
         if output_filename:
-            self.pdf.output(output_filename)
+            with self.profiler.stage('pdf.output'):
+                if self.sharded_output is not None:
+                    with open(output_filename, 'wb') as output_file:
+                        output_file.write(self.sharded_output)
+                else:
+                    self.pdf.output(output_filename)
+
+        # The metrics are written while the PDF is; a failed export raises here unless the caller waits for it later
+        if wait_export:
+            self.metrics_export.wait()
+
+
+class ReportBatch:
+
+    # Settings every report starts from; a config file's [defaults] table and each report entry override them
+    defaults = {'year': 2022, 'ownership_types': ['Single Family Residences', 'Condominiums', 'Co-ops'],
+                'site_name': 'HAGENBERGSTROM.COM', 'title': None, 'data': {}, 'regions': {}, 'assets': {},
+                'fonts': None, 'colors': None, 'forecast': [], 'charts': True, 'chart_format': 'png',
+                'workers': None, 'sharded': False, 'output': None, 'metrics_dir': None, 'metrics_formats': None,
+                'metrics_store': None, 'metrics_cube': None, 'median_error': None, 'image_cache': None,
+                'image_dpi': 300}
+
+    def __init__(self, configs):
+
+        self.configs = [self.normalize(config) for config in configs]
+        self.metrics_cache = MetricsCache(maxsize=4096)
+        self.metrics_stores = {}
+        self.image_assets = {}
+        self.frames = {}
+        self.fingerprints = {}
+        self.results = []
+
+        # Reports reading the same data share one load, filtered to the union of their regions and ownership types
+        self.sources = {}
+        for config in self.configs:
+            source = self.sources.setdefault(self.data_key(config), {'regions': {}, 'ownership_types': []})
+            for name, region in config['regions'].items():
+                source['regions'][f'{len(source["regions"])} {name}'] = region
+            source['ownership_types'] += [ownership for ownership in config['ownership_types']
+                                          if ownership not in source['ownership_types']]
+
+    @classmethod
+    def from_files(cls, paths):
+
+        return cls([config for path in paths for config in cls.read_config(path)])
+
+    @classmethod
+    def read_config(cls, path):
+
+        with open(path, 'rb') as config_file:
+            if path.lower().endswith(('.yaml', '.yml')):
+                import yaml
+                document = yaml.safe_load(config_file)
+            else:
+                import tomllib
+                document = tomllib.load(config_file)
+
+        # Either one report per file, or a [defaults] table plus a list of [[reports]]
+        defaults = document.pop('defaults', {})
+        entries = document.pop('reports', None) or [document]
+        base = os.path.dirname(os.path.abspath(path))
+
+        return [cls.resolve_paths(cls.merge(cls.merge(cls.defaults, defaults), entry), base) for entry in entries]
+
+    @classmethod
+    def merge(cls, base, override):
+
+        merged = dict(base)
+        for key, value in override.items():
+            if isinstance(value, dict) and isinstance(merged.get(key), dict) and key != 'regions':
+                merged[key] = cls.merge(merged[key], value)
+            else:
+                merged[key] = value
+
+        return merged
+
+    @staticmethod
+    def resolve_paths(config, base):
+
+        # Relative paths in a config file are relative to that file, not to wherever the job is started from
+        def resolve(path):
+
+            return path if path is None or os.path.isabs(path) else os.path.join(base, path)
+
+        config['data'] = {**config['data']}
+        for key in ['path', 'cache_dir']:
+            if config['data'].get(key):
+                config['data'][key] = resolve(config['data'][key])
+        config['assets'] = {key: [resolve(path) for path in value] if isinstance(value, list) else resolve(value)
+                            for key, value in config['assets'].items()}
+        if config['fonts']:
+            config['fonts'] = [(family, style, resolve(path)) for family, style, path in config['fonts']]
+        for key in ['output', 'metrics_dir', 'metrics_store', 'metrics_cube', 'image_cache']:
+            config[key] = resolve(config[key])
+
+        return config
+
+    @classmethod
+    def normalize(cls, config):
+
+        config = cls.merge(cls.defaults, config)
+        if not config['fonts'] or not config['colors']:
+            raise ValueError(f'Report config for {config["output"]!r} needs fonts and colors')
+
+        # Regions written out in a config can leave out the keys compose_report relies on
+        def region(name, spec, ownership_types):
+
+            spec = dict(spec)
+            spec.setdefault('name', name)
+            # The loader reads region columns as text, so labels written as TOML/YAML numbers (zip codes) are too
+            spec['labels'] = [str(label) for label in spec['labels']]
+            spec.setdefault('ownership_types', ownership_types)
+            spec.setdefault('analyze', True)
+            spec['subregions'] = {subname: region(subname, subspec, spec['ownership_types'])
+                                  for subname, subspec in (spec.get('subregions') or {}).items()}
+
+            return spec
+
+        config['regions'] = {name: region(name, spec, config['ownership_types'])
+                             for name, spec in config['regions'].items()}
+        config['colors'] = [tuple(color) for color in config['colors']]
+        config['fonts'] = [tuple(font) for font in config['fonts']]
+
+        return config
+
+    @staticmethod
+    def data_key(config):
+
+        # Synthetic listings are generated around the reporting year; a real export is the same file for any year
+        if config['data'].get('synthetic'):
+            return repr(sorted(config['data'].items())), config['year']
+
+        return repr(sorted(config['data'].items()))
+
+    def data(self, config):
+
+        key = self.data_key(config)
+        if key not in self.frames:
+            source = self.sources[key]
+            settings = config['data']
+            if settings.get('synthetic'):
+                df = SyntheticListings(settings['synthetic'], source['regions'], config['year'],
+                                       settings.get('seed', 0)).frame()
+            else:
+                df = ListingLoader(settings['path'], source['regions'], ownership_types=source['ownership_types'],
+                                   chunksize=settings.get('chunksize', 250000),
+                                   cache_dir=settings.get('cache_dir')).load()
+            # Keyed for the metrics cache on the source data and the filter it was loaded with, so the frame itself
+            # never has to be hashed
+            fingerprint = hashlib.sha1(repr((self.data_source(config)['fingerprint'], sorted(source['ownership_types']),
+                                             sorted((region_type, sorted(map(str, labels))) for region_type, labels in
+                                                    ListingIndex.region_labels(source['regions']).items()))).encode())
+            self.frames[key] = ListingIndex.from_regions(df, source['regions'], fingerprint.hexdigest())
+
+        return self.frames[key]
+
+    def data_source(self, config):
+
+        # What a saved cube is checked against: the bytes of the listings file, or the settings synthetic listings
+        # are generated from. Hashing the file is much cheaper than parsing it, and is done once per batch
+        key = self.data_key(config)
+        if key not in self.fingerprints:
+            path = config['data'].get('path')
+            if path:
+                fingerprint = ListingLoader.file_digest(path).hexdigest() if os.path.exists(path) else None
+            else:
+                fingerprint = hashlib.sha1(repr(key).encode()).hexdigest()
+            self.fingerprints[key] = {'path': path, 'fingerprint': fingerprint}
+
+        return self.fingerprints[key]
+
+    def chunks(self, config):
+
+        key = self.data_key(config)
+        source = self.sources[key]
+        settings = config['data']
+        if settings.get('synthetic'):
+            return SyntheticListings(settings['synthetic'], source['regions'], config['year'],
+                                     settings.get('seed', 0)).chunks()
+
+        return ListingLoader(settings['path'], source['regions'], ownership_types=source['ownership_types'],
+                             chunksize=settings.get('chunksize', 250000)).chunks()
+
+    def sketch_cube(self, config, report):
+
+        # With median_error set, the cube is built from the export chunk by chunk (across the config's workers), with
+        # medians within that relative error, instead of from the whole frame in memory
+        return MetricsCube.build_sketched(self.chunks(config), config['ownership_types'], config['regions'],
+                                          report.metrics_windows(report.current_year, report.history_start),
+                                          report.price_thresholds, report.price_labels, error=config['median_error'],
+                                          workers=config['workers'])
+
+    def report(self, config):
+
+        metrics_store = None
+        if config['metrics_store']:
+            metrics_store = self.metrics_stores.setdefault(config['metrics_store'],
+                                                           MetricsStore(config['metrics_store']))
+
+        # Reports with the same image settings share prepared images, so a cover used by every agent is resampled once
+        image_assets = self.image_assets.setdefault((config['image_cache'], config['image_dpi']),
+                                                    ImageAssets(config['image_cache'], config['image_dpi']))
+
+        output = config['output'] or 'report.pdf'
+        metrics_export = MetricsExport(config['metrics_dir'] or os.path.dirname(os.path.abspath(output)),
+                                       f'{os.path.splitext(os.path.basename(output))[0]} metrics',
+                                       config['metrics_formats'])
+
+        # A cube saved from different listings than the config's is rebuilt rather than reused
+        metrics_cube = None
+        source = self.data_source(config)
+        if config['metrics_cube'] and os.path.exists(config['metrics_cube']) and source['fingerprint']:
+            metrics_cube = MetricsCube.load(config['metrics_cube'], source)
+
+        return Report(config['colors'], config['fonts'], metrics_cache=self.metrics_cache,
+                      chart_format=config['chart_format'], metrics_store=metrics_store,
+                      current_year=config['year'], metrics_export=metrics_export, site_name=config['site_name'],
+                      report_title=config['title'], image_assets=image_assets, metrics_cube=metrics_cube)
+
+    def run(self):
+
+        exports = []
+        for config in self.configs:
+            start = time.perf_counter()
+            try:
+                report = self.report(config)
+
+                # A saved cube that covers every section re-renders the report without loading the listings
+                loaded = report.cube_covers(config['ownership_types'], config['regions'])
+                if config['median_error'] and not loaded:
+                    report.metrics_cube = self.sketch_cube(config, report)
+                cached = report.cube_covers(config['ownership_types'], config['regions'])
+                df = None if cached else self.data(config)
+                report.compose_report(df, config['ownership_types'], config['regions'],
+                                      forecast_text=[tuple(section) for section in config['forecast']],
+                                      charts=config['charts'], output_filename=config['output'],
+                                      workers=config['workers'], assets=config['assets'], sharded=config['sharded'],
+                                      cube=bool(config['metrics_cube']), wait_export=False)
+                if config['metrics_cube'] and not loaded:
+                    os.makedirs(os.path.dirname(config['metrics_cube']), exist_ok=True)
+                    report.metrics_cube.source = self.data_source(config)
+                    report.metrics_cube.save(config['metrics_cube'])
+                exports.append((len(self.results), report.metrics_export))
+                error = None
+            except Exception as exception:
+                error = f'{type(exception).__name__}: {exception}'
+
+            self.results.append({'output': config['output'], 'seconds': round(time.perf_counter() - start, 2),
+                                 'error': error})
+            if error:
+                logger.error('%s: %s (%s s)', config['output'], error, self.results[-1]['seconds'])
+            else:
+                logger.info('%s: done (%s s)', config['output'], self.results[-1]['seconds'])
+
+        # Metrics files are written in the background while later reports render; only the batch waits for them
+        for i, metrics_export in exports:
+            try:
+                metrics_export.wait()
+            except Exception as exception:
+                self.results[i]['error'] = f'{type(exception).__name__}: {exception}'
+                logger.error('%s: metrics export failed: %s', self.results[i]['output'], self.results[i]['error'])
+
+        return self.results
+
+
+class ReportServer:
+
+    # Keeps the listings, indexes and computed metrics of a batch config in memory and renders reports on request:
+    #   GET /report?region=Arlington&ownership=Condominiums   PDF; region and ownership can repeat, charts=0 skips charts
+    #   GET /metrics?region=Arlington&format=json             metrics in long format, csv (default) or json
+    #   GET /stats                                            request latency percentiles, cache and reload counts
+    # Any report in the config can be picked with report=<output file name>; the first one is used otherwise
+    latency_window = 1000
+
+    def __init__(self, config_paths, poll_interval=2.0, warm=True):
+
+        self.config_paths = [os.path.abspath(path) for path in config_paths]
+        self.poll_interval = poll_interval
+        self.warm = warm
+        # Renders are serialized by one lock; the served batch and the request stats have their own, which is never
+        # held for long, so a reload can be swapped in and /stats answered while a report renders
+        self.lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.latencies = {}
+        self.counts = {}
+        self.reloads = 0
+        self.started = datetime.datetime.now()
+
+        self.batch, self.watched = self.load()
+        self.loaded = datetime.datetime.now()
+
+    def watched_paths(self, batch):
+
+        return self.config_paths + [config['data']['path'] for config in batch.configs if config['data'].get('path')]
+
+    def load(self):
+
+        batch = ReportBatch.from_files(self.config_paths)
+        watched = {path: os.stat(path).st_mtime_ns for path in self.watched_paths(batch)}
+
+        # Data, plotting imports and (when warming) the metrics of every configured section are paid for here, once,
+        # rather than by the first request
+        pyplot()
+        for config in batch.configs:
+            df = batch.data(config)
+            if self.warm:
+                report = batch.report({**config, 'metrics_formats': []})
+                for ownership, region, with_charts in Report.section_tasks(config['ownership_types'],
+                                                                          config['regions']):
+                    report.generate_metrics(df, ownership=ownership, region=region)
+
+        return batch, watched
+
+    def watch(self):
+
+        # A new batch is built next to the one being served and swapped in once it is ready, so requests keep being
+        # answered from the old data while the new file loads; a file that fails to load leaves the old data in place
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                current = {path: os.stat(path).st_mtime_ns for path in self.watched}
+            except OSError:
+                continue
+            if current == self.watched:
+                continue
+
+            start = time.perf_counter()
+            try:
+                batch, watched = self.load()
+            except Exception as exception:
+                with self.state_lock:
+                    self.watched = current
+                logger.warning('Reload failed, still serving the previous data: %s: %s', type(exception).__name__,
+                               exception)
+                continue
+
+            with self.state_lock:
+                self.batch, self.watched = batch, watched
+                self.loaded = datetime.datetime.now()
+                self.reloads += 1
+            logger.info('Reloaded %s (%.1f s)', ', '.join(os.path.basename(path) for path in current),
+                        time.perf_counter() - start)
+
+    def select(self, query):
+
+        # The request is answered from the batch being served when it arrives, even if a reload swaps it meanwhile
+        with self.state_lock:
+            batch = self.batch
+
+        configs = batch.configs
+        if 'report' in query:
+            name = query['report'][-1]
+            matches = [config for config in configs if config['output'] and (
+                    os.path.splitext(os.path.basename(config['output']))[0] == os.path.splitext(name)[0])]
+            if not matches:
+                raise ValueError(f'No report named {name!r}')
+            config = matches[0]
+        else:
+            config = configs[0]
+
+        ownership_types = query.get('ownership', config['ownership_types'])
+        unknown = [ownership for ownership in ownership_types if ownership not in config['ownership_types']]
+        if unknown:
+            raise ValueError(f'Unknown ownership type {unknown[0]!r}')
+
+        # Subregions can be asked for by name too, and are then reported like a region of their own
+        regions = {}
+        for name in query.get('region', list(config['regions'])):
+            if name in config['regions']:
+                regions[name] = config['regions'][name]
+                continue
+            subregions = [region['subregions'][name] for region in config['regions'].values()
+                          if name in region['subregions']]
+            if not subregions:
+                raise ValueError(f'Unknown region {name!r}')
+            regions[name] = {**subregions[0], 'subregions': {}}
+
+        return batch, config, ownership_types, regions
+
+    def render(self, query):
+
+        batch, config, ownership_types, regions = self.select(query)
+        charts = query.get('charts', ['1'])[-1].lower() not in ('0', 'false', 'no')
+
+        # Served reports are drawn in this process, whatever the config's workers: the metrics are already cached,
+        # and a pool per request would pay its startup and a copy of the listings every time
+        with self.lock:
+            report = batch.report({**config, 'metrics_formats': []})
+            report.compose_report(batch.data(config), ownership_types, regions,
+                                  forecast_text=[tuple(section) for section in config['forecast']], charts=charts,
+                                  assets=config['assets'])
+
+        return report.sharded_output if report.sharded_output is not None else bytes(report.pdf.output())
+
+    def metrics(self, query):
+
+        batch, config, ownership_types, regions = self.select(query)
+
+        with self.lock:
+            report = batch.report({**config, 'metrics_formats': []})
+            df = batch.data(config)
+            frames = {(ownership, region['name']): (region['region_type'],
+                                                    report.generate_metrics(df, ownership=ownership, region=region))
+                      for ownership in ownership_types for region in regions.values()
+                      if ownership in region['ownership_types']}
+
+        if not frames:
+            raise ValueError('None of the regions has listings of these ownership types')
+
+        long = MetricsExport.long_frame(frames)
+        if query.get('format', ['csv'])[-1] == 'json':
+            return 'application/json', long.to_json(orient='records').encode()
+        return 'text/csv', long.to_csv(index=False).encode()
+
+    def stats(self):
+
+        # Request threads keep appending, so the numbers are copied out first and summarized outside the lock
+        with self.state_lock:
+            latencies = {endpoint: np.array(seconds) for endpoint, seconds in self.latencies.items()}
+            counts = {endpoint: dict(endpoint_counts) for endpoint, endpoint_counts in self.counts.items()}
+            batch, loaded, reloads = self.batch, self.loaded, self.reloads
+
+        endpoints = {}
+        for endpoint, seconds in latencies.items():
+            endpoints[endpoint] = {**counts[endpoint], 'p50_ms': round(np.percentile(seconds, 50) * 1000, 1),
+                                   'p99_ms': round(np.percentile(seconds, 99) * 1000, 1),
+                                   'max_ms': round(seconds.max() * 1000, 1)}
+
+        cache = batch.metrics_cache
+        return {'started': self.started.isoformat(timespec='seconds'),
+                'data_loaded': loaded.isoformat(timespec='seconds'), 'reloads': reloads,
+                'metrics_cache': {'entries': len(cache), 'hits': cache.hits, 'misses': cache.misses},
+                'endpoints': endpoints}
+
+    def respond(self, handler):
+
+        url = urllib.parse.urlsplit(handler.path)
+        query = urllib.parse.parse_qs(url.query)
+        endpoint = url.path.rstrip('/') or '/'
+
+        start = time.perf_counter()
+        try:
+            if endpoint == '/report':
+                status, content_type, body = 200, 'application/pdf', self.render(query)
+            elif endpoint == '/metrics':
+                status, (content_type, body) = 200, self.metrics(query)
+            elif endpoint == '/stats':
+                status, content_type, body = 200, 'application/json', json.dumps(self.stats(), indent=1).encode()
+            else:
+                status, content_type, body = 404, 'text/plain', f'Unknown endpoint {endpoint}'.encode()
+        except ValueError as exception:
+            status, content_type, body = 400, 'text/plain', str(exception).encode()
+        except Exception as exception:
+            status, content_type, body = 500, 'text/plain', f'{type(exception).__name__}: {exception}'.encode()
+        seconds = time.perf_counter() - start
+
+        # Latency is time spent producing the response; a slow client reading it doesn't count against the server
+        if status != 404:
+            with self.state_lock:
+                self.latencies.setdefault(endpoint, deque(maxlen=self.latency_window)).append(seconds)
+                counts = self.counts.setdefault(endpoint, {'requests': 0, 'errors': 0})
+                counts['requests'] += 1
+                counts['errors'] += status != 200
+
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    @staticmethod
+    def remove_socket(path):
+
+        # Only a socket left behind by an earlier server is cleared away, never some other file at that path
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(f'{path} exists and is not a socket')
+        os.remove(path)
+
+    def serve(self, port=8765, host='127.0.0.1', socket_path=None):
+
+        import http.server
+        import socketserver
+
+        report_server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                report_server.respond(self)
+
+            def log_message(self, format, *args):
+
+                pass
+
+        # Rendering is serialized by the server's lock, so the threads only keep /stats answering during a render
+        if socket_path:
+            self.remove_socket(socket_path)
+            server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+            logger.info('Serving reports on %s', socket_path)
+        else:
+            server = http.server.ThreadingHTTPServer((host, port), Handler)
+            logger.info('Serving reports on http://%s:%s', host, server.server_address[1])
+        server.daemon_threads = True
+
+        watcher = threading.Thread(target=self.watch, daemon=True)
+        watcher.start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            server.server_close()
+            if socket_path:
+                self.remove_socket(socket_path)
+
+
+class SyntheticListings:
+
+    # Counties and the cities inside them, shaped like the regions dicts compose_report walks
+    areas = {'Montgomery County': ('Montgomery', ['Bethesda', 'Chevy Chase', 'Potomac', 'Rockville', 'Silver Spring',
+                                                  'Gaithersburg']),
+             'District of Columbia': ('District of Columbia', ['Georgetown', 'Capitol Hill', 'Dupont Circle',
+                                                               'Foggy Bottom', 'Logan Circle']),
+             'Arlington County': ('Arlington', ['Arlington', 'Ballston', 'Clarendon', 'Rosslyn']),
+             'Fairfax County': ('Fairfax', ['McLean', 'Vienna', 'Reston', 'Great Falls', 'Falls Church'])}
+
+    ownership_types = ['Single Family Residences', 'Condominiums', 'Co-ops']
+    ownership_weights = [0.55, 0.3, 0.1, 0.05]
+    median_prices = [750000, 420000, 310000, 500000]
+
+    def __init__(self, rows, regions=None, current_year=2022, seed=0, chunksize=1000000):
+
+        self.rows = rows
+        self.regions = regions if regions is not None else self.make_regions()
+        self.current_year = current_year
+        self.seed = seed
+        self.chunksize = chunksize
+
+        # Every row lands in one leaf region; its labels fill the County/City/... columns along the path to it
+        self.paths = self.leaves()
+        self.region_types = sorted({region_type for path in self.paths for region_type in path})
+
+    @classmethod
+    def make_regions(cls, counties=None, analyzed=2):
+
+        regions = {}
+        for name in counties or cls.areas:
+            label, cities = cls.areas[name]
+            subregions = {city: {'name': city, 'region_type': 'City', 'labels': [city],
+                                 'ownership_types': cls.ownership_types[:2], 'analyze': i < analyzed,
+                                 'subregions': {}} for i, city in enumerate(cities)}
+            regions[name] = {'name': name, 'region_type': 'County', 'labels': [label],
+                             'ownership_types': cls.ownership_types, 'analyze': True, 'subregions': subregions}
+
+        return regions
+
+    def leaves(self):
+
+        paths = []
+        stack = [(region, {}) for region in self.regions.values()]
+        while stack:
+            region, path = stack.pop()
+            path = {**path, region['region_type']: region['labels'][0]}
+            if region.get('subregions'):
+                stack += [(subregion, path) for subregion in region['subregions'].values()]
+            else:
+                paths.append(path)
+
+        return sorted(paths, key=lambda path: sorted(path.items()))
+
+    def chunk(self, rows, rng):
+
+        as_of = np.datetime64(f'{self.current_year + 1}-01-01', 'D')
+        start = np.datetime64(f'{self.current_year - 3}-01-01', 'D')
+
+        # More listings come on in spring than in winter
+        days = np.arange(int((as_of - start) / np.timedelta64(1, 'D')))
+        season = 1 + 0.5 * np.sin(2 * np.pi * ((start + days).astype('datetime64[M]').astype(int) % 12 - 1) / 12)
+        listed = start + rng.choice(days, rows, p=season / season.sum()).astype('timedelta64[D]')
+
+        ownership = rng.choice(len(self.ownership_weights), rows, p=self.ownership_weights)
+        leaf = rng.integers(0, len(self.paths), rows)
+        leaf_premium = np.random.default_rng(self.seed).lognormal(0, 0.25, len(self.paths))
+        list_price = np.round(rng.lognormal(np.log(np.array(self.median_prices)[ownership] * leaf_premium[leaf]), 0.45),
+                              -3)
+
+        # Outcomes: sold, withdrawn or left to expire; anything not there yet by the end of the report year is active
+        outcome = rng.choice(3, rows, p=[0.7, 0.15, 0.15])
+        agreement = listed + np.ceil(rng.exponential(35, rows)).astype('timedelta64[D]')
+        settled = agreement + rng.integers(20, 60, rows).astype('timedelta64[D]')
+        off_market = listed + np.ceil(rng.exponential(np.where(outcome == 1, 60, 180))).astype('timedelta64[D]')
+
+        sold = (outcome == 0) & (agreement < as_of)
+        closed = sold & (settled < as_of)
+        pulled = (outcome > 0) & (off_market < as_of)
+        status = np.where(closed, 'Closed', np.where(sold, 'Pending', np.where(
+            pulled, np.where(outcome == 1, 'Withdrawn', 'Expired'), 'Active')))
+
+        nat = np.datetime64('NaT', 'D')
+        agreement = np.where(sold, agreement, nat)
+        settled = np.where(closed, settled, nat)
+        off_market = np.where(pulled, off_market, nat)
+        exited = np.fmin(np.fmin(agreement, off_market), as_of)
+        dom = ((exited - listed) / np.timedelta64(1, 'D')).astype(float)
+
+        sold_price = np.where(closed, np.round(list_price * rng.normal(1.0, 0.03, rows), -3), np.nan)
+        list_price[rng.random(rows) < 0.005] = np.nan
+        dom[rng.random(rows) < 0.01] = np.nan
+
+        df = pd.DataFrame({'Ownership': pd.Categorical.from_codes(
+            ownership, self.ownership_types + ['Timeshare/Fractional'])})
+        for region_type in self.region_types:
+            labels = [path.get(region_type) for path in self.paths]
+            categories = sorted({label for label in labels if label is not None})
+            codes = np.array([categories.index(label) if label is not None else -1 for label in labels])
+            df[region_type] = pd.Categorical.from_codes(codes[leaf], categories)
+
+        df['ListDate'] = listed.astype('datetime64[ns]')
+        df['OffMarketDate'] = off_market.astype('datetime64[ns]')
+        df['SettledDate'] = settled.astype('datetime64[ns]')
+        df['Agreement of Sale/Signed Lease Date'] = agreement.astype('datetime64[ns]')
+        df['Status'] = pd.Categorical(status, ['Active', 'Pending', 'Closed', 'Withdrawn', 'Expired'])
+        df['List Price'] = list_price
+        df['SoldPrice'] = sold_price
+        df['DOM'] = dom
+
+        return df
+
+    def chunks(self):
+
+        # Chunks get their own seeded streams, so large frames are built without holding every temporary at once
+        for i, start in enumerate(range(0, self.rows, self.chunksize)):
+            rng = np.random.default_rng([self.seed, i])
+            yield self.chunk(min(self.chunksize, self.rows - start), rng)
+
+    def frame(self):
+
+        return pd.concat(list(self.chunks()), ignore_index=True)
+
+    def write(self, path):
+
+        df = self.frame()
+        if path.endswith('.parquet'):
+            df.to_parquet(path, index=False)
+        else:
+            df.to_csv(path, index=False)
+
+        return path
+
+
+class ReportBenchmark:
+
+    sizes = [10000, 100000, 1000000, 5000000]
+    stages = ['startup', 'parse_data', 'generate_metrics', 'median', 'metrics_cube', 'charts', 'compose_report']
+    colors = [(1, 33, 105), (200, 200, 200), (31, 105, 255)]
+
+    # Seconds allowed for a fresh interpreter to import this script, and for the first and later Reports it builds
+    startup_budget = {'import': 1.0, 'report_init_cold': 0.25, 'report_init_warm': 0.01}
+
+    # Relative median error of the sketched cube, which is built from four chunks and checked against the exact one
+    sketch_error = 0.005
+    sketch_chunks = 4
+
+    def __init__(self, sizes=None, stages=None, regions=None, fonts=None, colors=None, repeat=3,
+                 results_path='benchmark results.csv', label=None, current_year=2022, seed=0):
+
+        self.sizes = sizes or self.sizes
+        self.stages = stages or self.stages
+        self.regions = regions if regions is not None else SyntheticListings.make_regions(
+            ['Montgomery County', 'District of Columbia'])
+        self.colors = colors or self.colors
+        self.repeat = repeat
+        self.results_path = results_path
+        self.current_year = current_year
+        self.seed = seed
+        self.exports = []
+
+        # Matplotlib's bundled DejaVu fonts stand in for the brand fonts, so the suite runs anywhere
+        if fonts is None:
+            import matplotlib as mpl
+            font_dir = os.path.join(mpl.get_data_path(), 'fonts', 'ttf')
+            fonts = [('Display', '', os.path.join(font_dir, 'DejaVuSans.ttf')),
+                     ('Body', '', os.path.join(font_dir, 'DejaVuSans.ttf')),
+                     ('Mono', '', os.path.join(font_dir, 'DejaVuSansMono.ttf'))]
+        self.fonts = fonts
+
+        # Results are labelled with a hash of this script unless told otherwise, so runs of different versions can
+        # be lined up against each other
+        if label is None:
+            with open(__file__, 'rb') as script:
+                label = hashlib.sha1(script.read()).hexdigest()[:10]
+        self.label = label
+
+    def make_assets(self, directory):
+
+        from PIL import Image
+
+        def image(name, size, color):
+
+            path = os.path.join(directory, name)
+            Image.new('RGB', size, color).save(path)
+
+            return path
+
+        logo = image('logo.png', (600, 150), (255, 255, 255))
+
+        return {'cover': image('cover.jpg', (1240, 1754), (90, 110, 140)), 'cover_logos': [logo],
+                'copyright_logos': [logo, logo], 'back_cover_logo': logo,
+                'section_images': [image(f'section {i}.jpg', (1240, 1754), (120 + 40 * i, 120, 110)) for i in range(3)]}
+
+    def report(self):
+
+        # Metrics exports land in the scratch directory and are waited on before it goes away
+        metrics_export = MetricsExport(os.getcwd())
+        self.exports.append(metrics_export)
+
+        return Report(self.colors, self.fonts, current_year=self.current_year, metrics_export=metrics_export)
+
+    def timed(self, function):
+
+        times = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - start)
+
+        return times, result
+
+    def run_size(self, rows, assets):
+
+        region = next(iter(self.regions.values()))
+        ownership = SyntheticListings.ownership_types[0]
+        start = datetime.datetime(self.current_year, 1, 1)
+        end = datetime.datetime(self.current_year + 1, 1, 1)
+
+        generate_start = time.perf_counter()
+        df = SyntheticListings(rows, self.regions, self.current_year, self.seed).frame()
+        index = ListingIndex.from_regions(df, self.regions)
+        results = [('generate_data', [time.perf_counter() - generate_start], {})]
+
+        if 'parse_data' in self.stages:
+            times, _ = self.timed(lambda: Report.parse_data(index, start, end, ownership, region))
+            results.append(('parse_data', times, {}))
+
+        # A fresh report per repeat, so metrics come from the engine rather than the cache
+        metrics = self.report().generate_metrics(index, ownership=ownership, region=region)
+        if 'generate_metrics' in self.stages:
+            times, _ = self.timed(lambda: self.report().generate_metrics(index, ownership=ownership, region=region))
+            results.append(('generate_metrics', times, {}))
+
+        if 'median' in self.stages:
+            # The engine's median kernel against the grouped median it replaced, on the (listing, window) pairs of the
+            # listings active at each window's end; both must give the same medians
+            windows = Report.metrics_windows(self.current_year)
+            engine = MetricsEngine(windows)
+            listings, members = engine.memberships(df)[0]
+            values = df['List Price'].to_numpy(dtype=float)[listings]
+            times, medians = self.timed(lambda: engine.median(values, members, len(windows)))
+            grouped_times, grouped = self.timed(
+                lambda: pd.Series(values).groupby(members).median().reindex(range(len(windows))).to_numpy())
+            if not np.array_equal(medians, grouped, equal_nan=True):
+                raise RuntimeError('MetricsEngine.median disagrees with groupby().median()')
+            results.append(('median', times, {'pairs': len(values), 'groupby_seconds': min(grouped_times),
+                                              'speedup': min(grouped_times) / min(times)}))
+
+        if 'metrics_cube' in self.stages:
+            report = self.report()
+            windows = report.metrics_windows(self.current_year, report.history_start)
+            ownership_types = SyntheticListings.ownership_types
+            times, exact = self.timed(lambda: MetricsCube.build(index, ownership_types, self.regions, windows))
+            results.append(('metrics_cube', times, {}))
+
+            chunksize = -(-len(df) // self.sketch_chunks)
+            times, sketched = self.timed(lambda: MetricsCube.build_sketched(
+                (df.iloc[i:i + chunksize] for i in range(0, len(df), chunksize)), ownership_types, self.regions,
+                windows, error=self.sketch_error))
+            accuracy = sketched.accuracy(exact)
+            medians = [name for name, population, statistic, value, unit in MetricRegistry.base
+                       if statistic == 'median']
+            results.append(('metrics_cube_sketched', times, {
+                'median_error_bound': self.sketch_error,
+                'max_median_error': accuracy.loc[medians, 'max_relative_error'].max(),
+                'max_other_error': accuracy.drop(medians)['max_relative_error'].max(),
+                'missing_cells': accuracy['missing'].sum()}))
+
+        if 'charts' in self.stages:
+            report = self.report()
+            times, _ = self.timed(lambda: report.charts(metrics, f'{region["name"]} {ownership}'))
+            report.close_charts()
+            results.append(('charts', times, {}))
+
+        if 'compose_report' in self.stages:
+
+            def compose():
+
+                report = self.report()
+                report.compose_report(index, SyntheticListings.ownership_types, self.regions, assets=assets)
+
+                return self.check_pdf(bytes(report.pdf.output()))
+
+            times, pdf = self.timed(compose)
+            results.append(('compose_report', times, {'pdf_bytes': len(pdf)}))
+
+        return [self.record(rows, stage, times, extra) for stage, times, extra in results]
+
+    def check_pdf(self, pdf):
+
+        # A written report embeds each of the benchmark's fonts once, including Display and Body, which share a file
+        descriptors = pdf.count(b'/Type /FontDescriptor')
+        if not pdf.startswith(b'%PDF-') or descriptors != len(self.fonts):
+            raise RuntimeError(f'Report PDF embeds {descriptors} fonts, expected {len(self.fonts)}')
+
+        return pdf
+
+    def record(self, rows, stage, times, extra=None):
+
+        return {'label': self.label, 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                'rows': rows, 'stage': stage, 'repeat': len(times), 'best_seconds': min(times),
+                'mean_seconds': sum(times) / len(times), 'python': platform.python_version(),
+                'numpy': np.__version__, 'pandas': pd.__version__, **(extra or {})}
+
+    def run_startup(self):
+
+        # Each repeat is a fresh interpreter, so imports and the font registry start cold
+        code = ('import importlib.util, time\n'
+                'start = time.perf_counter()\n'
+                f'spec = importlib.util.spec_from_file_location("market_report", {os.path.abspath(__file__)!r})\n'
+                'module = importlib.util.module_from_spec(spec)\n'
+                'spec.loader.exec_module(module)\n'
+                'times = [time.perf_counter() - start]\n'
+                'for _ in range(2):\n'
+                '    start = time.perf_counter()\n'
+                f'    module.Report({self.colors!r}, {self.fonts!r}, metrics_export=module.MetricsExport(formats=()))\n'
+                '    times.append(time.perf_counter() - start)\n'
+                'print(*times)\n')
+
+        runs = [list(map(float, subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                               check=True).stdout.split())) for _ in range(self.repeat)]
+
+        return [self.record(0, stage, [run[i] for run in runs],
+                            {'budget_seconds': self.startup_budget[stage],
+                             'over_budget': min(run[i] for run in runs) > self.startup_budget[stage]})
+                for i, stage in enumerate(['import', 'report_init_cold', 'report_init_warm'])]
+
+    def run(self):
+
+        results = []
+        results_path = os.path.abspath(self.results_path)
+        working_directory = os.getcwd()
+
+        # Runs inside a scratch directory with placeholder images, so nothing depends on the real assets
+        with tempfile.TemporaryDirectory() as directory:
+            assets = self.make_assets(directory)
+            os.chdir(directory)
+            try:
+                if 'startup' in self.stages:
+                    startup_results = self.run_startup()
+                    print(pd.DataFrame(startup_results)[['stage', 'best_seconds', 'budget_seconds']].to_string(
+                        index=False))
+                    results += startup_results
+
+                for rows in self.sizes:
+                    size_results = self.run_size(rows, assets)
+                    print(pd.DataFrame(size_results)[['rows', 'stage', 'best_seconds']].to_string(index=False))
+                    results += size_results
+            finally:
+                for metrics_export in self.exports:
+                    metrics_export.wait()
+                self.exports = []
+                os.chdir(working_directory)
+
+        results = pd.DataFrame(results)
+        results.to_csv(results_path, mode='a', index=False, header=not os.path.exists(results_path))
+
+        return results
+
+    @staticmethod
+    def compare(results_path, baseline, candidate):
+
+        # Best times per (rows, stage) for two labels side by side; ratios above 1 are regressions
+        results = pd.read_csv(results_path)
+        best = results[results['label'].isin([baseline, candidate])].pivot_table(
+            index=['rows', 'stage'], columns='label', values='best_seconds', aggfunc='min')
+        best['ratio'] = (best[candidate] / best[baseline]).round(3)
+
+        return best
+
+
+def process_pool(workers, **kwargs):
+
+    # Pools are started from processes that also run threads (image preloading, the report server's handlers), and a
+    # forked child can inherit a lock one of them held, such as an import lock mid-import, and hang on it. Workers are
+    # started from a clean process instead: a fork server where the platform has one, fresh interpreters otherwise
+    import multiprocessing
+
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method), **kwargs)
+
+
+_section_worker = {}
+
+
+def _init_section_worker(colors, fonts, options, df):
+
+    _section_worker['report'] = Report(colors, fonts, **options)
+    _section_worker['df'] = df
+
+
+def _render_section(task):
+
+    ownership, region, with_charts = task
+    report = _section_worker['report']
+
+    with report.profiler.stage('prerender_section', ownership, region):
+        metrics = report.generate_metrics(_section_worker['df'], ownership=ownership, region=region)
+        if with_charts:
+            images = report.charts(metrics, f'{region["name"]} {ownership}')
+        else:
+            images = None
+
+    return metrics, images, report.profiler.drain()
+
+
+def _chunk_partial(task):
+
+    chunk, ownership_types, specs, windows, price_thresholds, price_labels, error = task
+
+    index = ListingIndex(chunk, sorted({region_type for region_type, labels in specs}))
+    rows, groups, ngroups = MetricsCube.groups(index, ownership_types, specs)
+    engine = MetricsEngine(windows, price_thresholds, price_labels)
+
+    return engine.partial(chunk.iloc[rows], QuantileSketch(error), groups, ngroups)
+
+
+def _render_fragment(task):
+
+    unit, assets = task
+    report = _section_worker['report']
+
+    with report.profiler.stage('render_fragment', unit['ownership'], unit['region']):
+        with report.fragment() as pdf:
+            report.render_unit(_section_worker['df'], unit, assets=assets)
+            fragment = bytes(pdf.output())
+
+    return fragment, report.metrics_export.drain(), report.profiler.drain()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Coldwell Banker annual market report')
+    parser.add_argument('configs', nargs='*', help='TOML or YAML report configs, all run in one batch')
+    parser.add_argument('--benchmark', action='store_true', help='time the report on synthetic listings')
+    parser.add_argument('--sizes', type=int, nargs='+', default=ReportBenchmark.sizes)
+    parser.add_argument('--stages', nargs='+', choices=ReportBenchmark.stages, default=ReportBenchmark.stages)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--results', default='benchmark results.csv')
+    parser.add_argument('--label')
+    parser.add_argument('--serve', action='store_true', help='keep the configs\' data loaded and render on request')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help='serve on a Unix socket instead of a TCP port')
+    parser.add_argument('--verbose', action='store_true', help='also log each section as its charts are drawn')
+    arguments = parser.parse_args()
+
+    # Batch and server progress goes to stderr; the benchmark prints its own results tables. Libraries (fontTools logs
+    # every font it subsets) stay at warnings
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.DEBUG if arguments.verbose else logging.INFO)
+
+    if arguments.benchmark:
+        ReportBenchmark(arguments.sizes, arguments.stages, repeat=arguments.repeat, results_path=arguments.results,
+                        label=arguments.label).run()
+    elif arguments.serve and arguments.configs:
+        ReportServer(arguments.configs).serve(arguments.port, arguments.host, arguments.socket)
+    elif arguments.configs:
+        results = ReportBatch.from_files(arguments.configs).run()
+        sys.exit(1 if any(result['error'] for result in results) else 0)
+    else:
+        parser.print_help()
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+# "CB Report.py" is not an importable module name. It is linked in under one on sys.path, rather than loaded from its
+# path, so the processes that worker pools start can import it and unpickle its functions too
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def market_report(tmp_path_factory):
+
+    directory = tmp_path_factory.mktemp('module')
+    os.symlink(os.path.join(ROOT, 'CB Report.py'), directory / 'market_report.py')
+    sys.path.insert(0, str(directory))
+
+    import market_report
+
+    return market_report
+
+
+@pytest.fixture(scope='session')
+def benchmark(market_report):
+
+    return market_report.ReportBenchmark(repeat=1, label='tests')
+
+
+@pytest.fixture(scope='session')
+def assets(benchmark, tmp_path_factory):
+
+    return benchmark.make_assets(tmp_path_factory.mktemp('assets'))
+
+
+@pytest.fixture(scope='session')
+def regions(benchmark):
+
+    return benchmark.regions
+
+
+@pytest.fixture(scope='session')
+def listings(market_report, regions):
+
+    # Below about 10,000 rows some sections have no sales at all, which the charts aren't drawn for
+    return market_report.SyntheticListings(10000, regions).frame()
+
+
+@pytest.fixture
+def make_report(market_report, benchmark, tmp_path, monkeypatch):
+
+    # Anything a render writes relative to the working directory lands in the test's own directory
+    monkeypatch.chdir(tmp_path)
+
+    def make(**kwargs):
+
+        return market_report.Report(benchmark.colors, benchmark.fonts,
+                                    metrics_export=market_report.MetricsExport(formats=()), **kwargs)
+
+    return make
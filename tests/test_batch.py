@@ -0,0 +1,17 @@
+import numpy as np
+
+
+def test_numeric_region_labels_match_text_columns(market_report, benchmark, listings, tmp_path):
+
+    # Zip codes come out of TOML and YAML as integers; the loader reads region columns as text
+    df = listings.copy()
+    df['Zip'] = np.where(df['City'] == 'Bethesda', '20815', '20001')
+    df.to_csv(tmp_path / 'listings.csv', index=False)
+
+    config = market_report.ReportBatch.normalize({
+        'fonts': benchmark.fonts, 'colors': benchmark.colors, 'data': {'path': str(tmp_path / 'listings.csv')},
+        'regions': {'Bethesda': {'region_type': 'Zip', 'labels': [20815]}}})
+    assert config['regions']['Bethesda']['labels'] == ['20815']
+
+    index = market_report.ReportBatch([config]).data(config)
+    assert len(index.df) == ((df['Zip'] == '20815') & df['Ownership'].isin(config['ownership_types'])).sum() > 0
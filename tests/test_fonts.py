@@ -0,0 +1,27 @@
+import logging
+
+from fpdf import FPDF
+
+
+def test_cid_keyed_cff_font_needs_pdf_1_6(market_report, benchmark, monkeypatch):
+
+    # pdf.add_font raises the PDF version for CID-keyed CFF fonts; fonts copied from the registry must too
+    family, style, path = benchmark.fonts[2]
+    prototype = market_report.FontRegistry.prototype(family, style, path)[0]
+    monkeypatch.setattr(prototype, 'is_cff', True)
+    monkeypatch.setattr(prototype, 'is_cid_keyed', True)
+
+    pdf = FPDF()
+    market_report.FontRegistry.add_font(pdf, family, style, path)
+
+    assert pdf.pdf_version == '1.6'
+
+
+def test_missing_font_is_skipped_with_a_warning(market_report, benchmark, tmp_path, caplog):
+
+    fonts = benchmark.fonts + [('Missing', '', str(tmp_path / 'missing.ttf'))]
+    with caplog.at_level(logging.WARNING, logger=market_report.__name__):
+        report = market_report.Report(benchmark.colors, fonts)
+
+    assert report.font_families == [family for family, style, path in benchmark.fonts]
+    assert 'missing.ttf' in caplog.text
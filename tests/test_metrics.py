@@ -0,0 +1,163 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+DATE_COLUMNS = ['ListDate', 'OffMarketDate', 'SettledDate', 'Agreement of Sale/Signed Lease Date']
+OWNERSHIP_TYPES = ['Single Family Residences', 'Condominiums', 'Co-ops']
+
+
+def baseline_row(df, start, end):
+
+    # The describe()-based parse_data the metrics engine replaced; the engine has to reproduce it exactly
+    price_thresholds = [0, 500000, 750000, 1000000, 1500000, 2000000, 10000000]
+
+    active_listings = df[(df.ListDate < end) & ~(df.OffMarketDate < end) & ~(df.SettledDate < end) & ~(
+            df['Agreement of Sale/Signed Lease Date'] < end)]
+    new_listings = df[(df.ListDate >= start) & (df.ListDate < end)]
+    sold_listings = df[(df.SettledDate >= start) & (df.SettledDate < end) & (df.Status.isin(['Closed']))]
+
+    row = pd.concat([active_listings['List Price'].describe().round(0).iloc[[0, 1, 5]].set_axis(
+        ['Active Listings', 'Active Average List Price', 'Active Median List Price']),
+        active_listings['DOM'].describe().round(0).iloc[[1, 5]].set_axis(
+            ['Active Average Days on Market', 'Active Median Days on Market']),
+        new_listings['List Price'].describe().round(0).iloc[[0, 1, 5]].set_axis(
+            ['New Listings', 'New Average List Price', 'New Median List Price']),
+        new_listings['DOM'].describe().round(0).iloc[[1, 5]].set_axis(
+            ['New Average Days on Market', 'New Median Days on Market']),
+        sold_listings['List Price'].describe().round(0).iloc[[0, 1, 5]].set_axis(
+            ['Sold Listings', 'Sold Average List Price', 'Sold Median List Price']),
+        sold_listings['SoldPrice'].describe().round(0).iloc[[1, 5]].set_axis(
+            ['Sold Average Sale Price', 'Sold Median Sale Price']),
+        sold_listings['DOM'].describe().round(0).iloc[[1, 5]].set_axis(
+            ['Sold Average Days on Market', 'Sold Median Days on Market'])])
+
+    price_ranges = pd.cut(active_listings['List Price'], price_thresholds, right='False')
+    dom_breakdown = active_listings.groupby(by=price_ranges, observed=False)['DOM'].mean().set_axis(
+        ['< $500k', r'\$500k - \$750k', r'\$750k - \$1M', r'\$1M - \$1.5M', r'\$1.5M - \$2M', r'> \$2M'])
+    dom_breakdown.index.names = [None]
+    row = pd.concat([row, dom_breakdown])
+
+    row.loc['Sold/List Price Ratio'] = round((sold_listings.SoldPrice / sold_listings['List Price']).mean() * 100, 2)
+
+    return row
+
+
+def baseline_metrics(df, ownership=None, region=None, current_year=2022, history_start=None):
+
+    # The original generate_metrics, one parse_data call per window, with its monthly history starting at history_start
+    if ownership:
+        df = df[df.Ownership.isin([ownership]).fillna(False)]
+    if region:
+        df = df[df[region['region_type']].isin(region['labels']).fillna(False)]
+
+    dates = [date.to_pydatetime() for date in pd.date_range(
+        history_start or datetime.datetime(current_year - 1, 1, 1), datetime.datetime(current_year + 1, 1, 1),
+        freq='MS')]
+    metrics = pd.DataFrame()
+    for start, end in zip(dates[:-1], dates[1:]):
+        metrics[end] = baseline_row(df, start, end)
+    metrics = metrics.T
+
+    metrics['Months of Supply'] = (3 * metrics['Active Listings'] / metrics['Sold Listings'].rolling(window=3).sum()
+                                   ).round(1)
+
+    start = datetime.datetime(current_year, 1, 1)
+    end = datetime.datetime(current_year + 1, 1, 1)
+    past_start = start.replace(year=current_year - 1)
+    past_end = end.replace(year=current_year)
+
+    current_year_metrics = baseline_row(df, start, end).rename(f'{current_year}')
+    past_year_metrics = baseline_row(df, past_start, past_end).rename(f'{current_year - 1}')
+
+    metrics = pd.concat([past_year_metrics.to_frame().T, metrics], ignore_index=False)
+    metrics = pd.concat([current_year_metrics.to_frame().T, metrics], ignore_index=False)
+
+    metrics.loc[f'{current_year}', 'Months of Supply'] = metrics.loc[end, 'Months of Supply']
+    metrics.loc[f'{current_year - 1}', 'Months of Supply'] = metrics.loc[past_end, 'Months of Supply']
+
+    metrics_all = metrics.copy()
+    for date in metrics.index:
+        try:
+            yoy = ((metrics.loc[date] / metrics.loc[date.replace(year=date.year - 1)] - 1) * 100).round(1).set_axis(
+                [f'{item} YoY % Change' for item in metrics.columns])
+            metrics_all.loc[date, yoy.index] = yoy
+        except (AttributeError, KeyError):
+            yoy = ((metrics.loc[f'{current_year}'] / metrics.loc[f'{current_year - 1}'] - 1) * 100).round(1).set_axis(
+                [f'{item} YoY % Change' for item in metrics.columns])
+            metrics_all.loc[f'{current_year}', yoy.index] = yoy
+
+    metrics_all.replace(np.inf, np.nan, inplace=True)
+    metrics_all.replace(-np.inf, np.nan, inplace=True)
+
+    return metrics_all
+
+
+@pytest.fixture(scope='module')
+def edge_listings(listings):
+
+    # Missing dates, dates exactly on a month boundary and dates with a time of day, each in about 3% of the rows of
+    # every date column: the engine buckets dates where the original compared them
+    df = listings.copy()
+    rng = np.random.default_rng(1)
+    for column in DATE_COLUMNS:
+        dates = df[column].astype('datetime64[ns]')
+        boundary, timed, missing = np.array_split(rng.choice(len(df), len(df) // 10, replace=False), 3)
+        dates.iloc[boundary] = dates.iloc[boundary].dt.to_period('M').dt.start_time
+        dates.iloc[timed] += pd.to_timedelta(rng.integers(1, 86400, len(timed)), unit='s')
+        dates.iloc[missing] = pd.NaT
+        df[column] = dates
+
+    return df
+
+
+def sections(market_report, regions):
+
+    return [(None, None)] + [(ownership, region) for ownership, region, charts in
+                             market_report.Report.section_tasks(OWNERSHIP_TYPES, regions)]
+
+
+def test_engine_matches_baseline_metrics(market_report, make_report, edge_listings, regions):
+
+    report = make_report()
+    index = market_report.ListingIndex.from_regions(edge_listings, regions)
+    for ownership, region in sections(market_report, regions):
+        pd.testing.assert_frame_equal(report.generate_metrics(index, ownership, region),
+                                      baseline_metrics(edge_listings, ownership, region), check_exact=True)
+
+
+def test_cube_matches_direct_metrics(market_report, make_report, edge_listings, regions):
+
+    direct = make_report()
+    windows = direct.metrics_windows(direct.current_year, direct.history_start)
+    index = market_report.ListingIndex.from_regions(edge_listings, regions)
+    cube = market_report.MetricsCube.build(index, OWNERSHIP_TYPES, regions, windows)
+    cubed = make_report(metrics_cube=cube)
+
+    for ownership, region in sections(market_report, regions):
+        if ownership is None:
+            continue
+        assert cube.covers(ownership, region, windows, direct.price_thresholds)
+        pd.testing.assert_frame_equal(cubed.generate_metrics(None, ownership, region),
+                                      direct.generate_metrics(index, ownership, region), check_exact=True)
+
+
+def test_history_start_extends_the_monthly_rows(market_report, make_report, edge_listings, regions):
+
+    history_start = datetime.datetime(2019, 6, 1)
+    report = make_report(history_start=history_start)
+    index = market_report.ListingIndex.from_regions(edge_listings, regions)
+    region = next(iter(regions.values()))
+
+    metrics = report.generate_metrics(index, 'Condominiums', region)
+    assert metrics.index[2] == pd.Timestamp(2019, 7, 1)
+    pd.testing.assert_frame_equal(metrics, baseline_metrics(edge_listings, 'Condominiums', region,
+                                                            history_start=history_start), check_exact=True)
+
+
+@pytest.mark.parametrize('history_start', [datetime.datetime(2021, 2, 1), datetime.datetime(2022, 1, 1), '2021-06-01'])
+def test_history_start_after_january_of_the_prior_year_is_rejected(make_report, history_start):
+
+    with pytest.raises(ValueError, match='history_start'):
+        make_report(history_start=history_start)
@@ -0,0 +1,53 @@
+import pypdf
+import pytest
+
+
+def render(report, listings, ownership_types, regions, assets, path, **kwargs):
+
+    report.compose_report(listings, ownership_types, regions, assets=assets, output_filename=str(path), **kwargs)
+
+    return [page.extract_text() for page in pypdf.PdfReader(path).pages]
+
+
+def test_workers_render_matches_sequential(make_report, listings, regions, assets, tmp_path):
+
+    # Worker pools are started while the image preload's threads are running; forked from there, they could hang
+    ownership_types = ['Single Family Residences', 'Condominiums']
+    sequential = render(make_report(), listings, ownership_types, regions, assets, tmp_path / 'sequential.pdf')
+    parallel = render(make_report(), listings, ownership_types, regions, assets, tmp_path / 'parallel.pdf', workers=2)
+
+    assert parallel == sequential
+
+
+def test_preload_matches_section_pages_by_title(make_report, listings, regions, assets, tmp_path):
+
+    report = make_report()
+    render(report, listings, ['Condominiums'], regions, assets, tmp_path / 'condos.pdf')
+
+    section_images = {path for path, width, height in report.image_assets.prepared if height == 297}
+    assert section_images == {assets['section_images'][1]}
+
+
+@pytest.mark.parametrize('mode', [{}, {'workers': 2}, {'workers': 2, 'sharded': True}],
+                         ids=['sequential', 'workers', 'sharded'])
+def test_pages_and_contents_links_follow_the_plan(make_report, listings, regions, assets, tmp_path, mode):
+
+    ownership_types = ['Single Family Residences', 'Condominiums']
+    report = make_report()
+    report.compose_report(listings, ownership_types, regions, assets=assets, output_filename=str(tmp_path / 'r.pdf'),
+                          **mode)
+    plan = report.page_plan(ownership_types, regions)
+    reader = pypdf.PdfReader(tmp_path / 'r.pdf')
+    assert len(reader.pages) == plan[-1]['page']
+
+    # Each contents entry links to the first page of its unit, which opens with that unit's title and footer number
+    entries = [unit for unit in plan if unit['level'] is not None]
+    pages = [page.indirect_reference for page in reader.pages]
+    links = [pages.index(annotation.get_object()['/Dest'][0]) + 1 for annotation in reader.pages[2]['/Annots']]
+    assert links == [unit['page'] for unit in entries]
+
+    for unit in entries:
+        text = reader.pages[unit['page'] - 1].extract_text()
+        assert unit['title'].upper() in text.replace('\n', ' ').upper()
+        if unit['kind'] == 'section':
+            assert text.splitlines()[1] == str(unit['number'])
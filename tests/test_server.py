@@ -0,0 +1,71 @@
+import io
+import json
+
+import pytest
+import yaml
+
+
+class Handler:
+
+    # Stands in for the http.server handler ReportServer.respond writes to
+    def __init__(self, path):
+
+        self.path = path
+        self.headers = {}
+        self.wfile = io.BytesIO()
+
+    def send_response(self, status):
+
+        self.status = status
+
+    def send_header(self, name, value):
+
+        self.headers[name] = value
+
+    def end_headers(self):
+
+        pass
+
+
+@pytest.fixture(scope='module')
+def server(market_report, benchmark, assets, regions, tmp_path_factory):
+
+    directory = tmp_path_factory.mktemp('server')
+    config = {'fonts': [list(font) for font in benchmark.fonts], 'colors': [list(color) for color in benchmark.colors],
+              'data': {'synthetic': 10000}, 'assets': assets, 'regions': regions, 'output': 'out/agent.pdf'}
+    with open(directory / 'agent.yaml', 'w') as config_file:
+        yaml.safe_dump(config, config_file)
+
+    return market_report.ReportServer([str(directory / 'agent.yaml')], warm=False)
+
+
+def get(server, path):
+
+    handler = Handler(path)
+    server.respond(handler)
+
+    return handler.status, handler.wfile.getvalue().decode()
+
+
+@pytest.mark.parametrize('path, message', [
+    ('/report?report=nobody', "No report named 'nobody'"),
+    ('/report?ownership=Castles', "Unknown ownership type 'Castles'"),
+    ('/metrics?region=Atlantis', "Unknown region 'Atlantis'"),
+    # Bethesda's listings are single family and condo only
+    ('/metrics?region=Bethesda&ownership=Co-ops', 'None of the regions has listings of these ownership types')])
+def test_bad_requests_are_answered_with_400(server, path, message):
+
+    assert get(server, path) == (400, message)
+
+
+def test_bad_requests_are_counted_as_errors(server):
+
+    status, body = get(server, '/metrics?region=Bethesda&format=json')
+    assert status == 200 and json.loads(body)
+    assert get(server, '/metrics?region=Atlantis')[0] == 400
+    assert get(server, '/nowhere')[0] == 404
+
+    endpoints = json.loads(get(server, '/stats')[1])['endpoints']
+    assert endpoints['/metrics']['requests'] - endpoints['/metrics']['errors'] >= 1
+    assert endpoints['/metrics']['errors'] >= 1
+    assert '/nowhere' not in endpoints